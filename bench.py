@@ -0,0 +1,402 @@
+# coding=utf-8
+
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Offline benchmarks of the Geogotchi client.
+
+Starts a local stand-in for the geonames.org web services in a separate
+process, serving canned responses with optional latency and errors, and
+measures throughput, latency and allocations of each Geogotchi method in
+each client mode::
+
+    $ python bench.py --calls 2000 --threads 8 --latency 5
+    $ python bench.py --json results.json
+    $ python bench.py --baseline results.json
+
+Responses of recorded API calls can be served instead of the built-in ones
+with ``--payloads DIR``, a directory with one ``<path>.json`` file per API
+path, e.g. ``findNearbyJSON.json``.
+
+Requires Python 3.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from geogotchi import Geogotchi
+from geogotchi import errors
+from geogotchi.cache import MemoryCache
+from geogotchi.retry import RetryPolicy
+
+PATHS = ["findNearbyPlaceNameJSON", "findNearbyJSON",
+         "findNearbyWikipediaJSON", "hierarchyJSON", "searchJSON"]
+
+
+def _geoname(i, **extra):
+    # A geoname as returned by the API with style MEDIUM.
+    geoname = {
+            "geonameId": 2673730 + i,
+            "name": "Stockholm %d" % i,
+            "toponymName": "Stockholm %d" % i,
+            "lat": "%.5f" % (59.33258 + i * 0.001),
+            "lng": "%.5f" % (18.0649 + i * 0.001),
+            "countryCode": "SE",
+            "countryName": "Sweden",
+            "countryId": "2661886",
+            "adminCode1": "26",
+            "adminName1": "Stockholm",
+            "fcl": "P",
+            "fclName": "city, village,...",
+            "fcode": "PPLC",
+            "fcodeName": "capital of a political entity",
+            "population": 1515017 - i,
+            "distance": "%.5f" % (0.1 + i * 0.05),
+            }
+    geoname.update(extra)
+    return geoname
+
+
+def default_payloads():
+    """Built-in responses, shaped like real ones, by API path.
+    """
+    wikipedia = [{
+            "title": "Article %d" % i,
+            "summary": "Summary of article %d. " % i * 4,
+            "lat": 59.33 + i * 0.001,
+            "lng": 18.06 + i * 0.001,
+            "distance": "%.4f" % (0.05 * i),
+            "rank": (i * 37) % 100,
+            "lang": "en",
+            "countryCode": "SE",
+            "wikipediaUrl": "en.wikipedia.org/wiki/Article_%d" % i,
+            "elevation": 10,
+            "feature": "landmark",
+            } for i in range(50)]
+    hierarchy = [_geoname(i) for i in range(5)]
+    for geoname in hierarchy:
+        del geoname["distance"]
+    search = [_geoname(i) for i in range(100)]
+    for geoname in search:
+        del geoname["distance"]
+    return {
+            "findNearbyPlaceNameJSON": {"geonames": [_geoname(0)]},
+            "findNearbyJSON": {"geonames": [_geoname(0)]},
+            "findNearbyWikipediaJSON": {"geonames": wikipedia},
+            "hierarchyJSON": {"geonames": hierarchy},
+            "searchJSON": {"totalResultsCount": 100, "geonames": search},
+            }
+
+
+def load_payloads(directory):
+    payloads = default_payloads()
+    for path in PATHS:
+        filename = os.path.join(directory, path + ".json")
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                payloads[path] = json.loads(f.read().decode("utf-8"))
+    return payloads
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't let them wait on
+    # delayed acks.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        path = urlparse(self.path).path.lstrip("/")
+        body = server.bodies.get(path)
+        status = 200
+        if body is None:
+            status = 404
+            body = b"Not found"
+        elif random.random() < server.error_rate:
+            if server.error_kind == "http":
+                status = 503
+                body = b"Service unavailable"
+            else:
+                # "the server is busy", retryable.
+                body = json.dumps({"status": {
+                        "message": "the server is busy", "value": 13}})
+                body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(payloads, latency, error_rate, error_kind, ports):
+    """Run a stand-in server, putting its port on the `ports` queue.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.bodies = dict((path, json.dumps(payload).encode("utf-8"))
+                         for path, payload in payloads.items())
+    server.latency = latency
+    server.error_rate = error_rate
+    server.error_kind = error_kind
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(payloads, latency=0.0, error_rate=0.0, error_kind="geonames"):
+    """Start a stand-in server in a child process. Returns the process and
+    the base URL of the server.
+    """
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(
+            target=serve,
+            args=(payloads, latency, error_rate, error_kind, ports))
+    process.daemon = True
+    process.start()
+    port = ports.get(timeout=10)
+    return process, "http://127.0.0.1:%d/" % port
+
+
+def make_client(mode, base_url, threads):
+    kwargs = {"username": "bench", "base_url": base_url,
+              "pool_maxsize": threads}
+    if mode == "records":
+        kwargs["records"] = True
+    elif mode == "response_cache":
+        kwargs["response_cache"] = MemoryCache()
+    elif mode == "retry":
+        kwargs["retry_policy"] = RetryPolicy(backoff=0.001, max_backoff=0.01)
+    elif mode == "coalesce":
+        kwargs["coalesce"] = True
+    return Geogotchi(**kwargs)
+
+
+def make_calls(method, n, distinct):
+    """Arguments of `n` calls of `method`, cycling over `distinct` different
+    ones.
+    """
+    rng = random.Random(42)
+    latlons = [(rng.uniform(-60, 70), rng.uniform(-180, 180))
+               for _ in range(distinct)]
+    calls = []
+    for i in range(n):
+        latlon = latlons[i % distinct]
+        if method == "get_hierarchy":
+            calls.append(((2673730 + i % distinct,), {}))
+        elif method == "search":
+            calls.append(((), {"q": "place %d" % (i % distinct)}))
+        else:
+            calls.append(((latlon,), {}))
+    return calls
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = int(round(q / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run(client, method, calls, threads):
+    """Do `calls` with `threads` concurrent workers. Returns throughput in
+    calls per second, sorted latencies in seconds and the number of failed
+    calls.
+    """
+    func = getattr(client, method)
+    latencies = []
+    failed = [0]
+    lock = threading.Lock()
+
+    def call(args, kwargs):
+        start = time.perf_counter()
+        try:
+            func(*args, **kwargs)
+        except errors.GeogotchiError:
+            with lock:
+                failed[0] += 1
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in executor.map(lambda c: call(*c), calls):
+            pass
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(calls) / elapsed, latencies, failed[0]
+
+
+def allocations(client, method, calls):
+    """Mean peak of memory allocated while doing one call, in bytes, and
+    mean number of memory blocks still allocated after each call.
+    """
+    func = getattr(client, method)
+    tracemalloc.start()
+    try:
+        peaks = 0
+        blocks = 0
+        for args, kwargs in calls:
+            # Forgets earlier blocks and resets the peak, so what is traced
+            # below was allocated by this call.
+            tracemalloc.clear_traces()
+            try:
+                result = func(*args, **kwargs)
+            except errors.GeogotchiError:
+                result = None
+            peaks += tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            blocks += sum(stat.count
+                          for stat in snapshot.statistics("filename"))
+            del result, snapshot
+    finally:
+        tracemalloc.stop()
+    return peaks / float(len(calls)), blocks / float(len(calls))
+
+
+def benchmark(base_url, methods, modes, n_calls, threads, distinct,
+              alloc_calls):
+    results = []
+    for mode in modes:
+        for method in methods:
+            client = make_client(mode, base_url, threads)
+            calls = make_calls(method, n_calls, distinct)
+            # Warm up connections and caches.
+            run(client, method, calls[:threads], threads)
+            throughput, latencies, failed = run(client, method, calls,
+                                                threads)
+            peak, blocks = allocations(client, method, calls[:alloc_calls])
+            client.close()
+            results.append({
+                    "mode": mode,
+                    "method": method,
+                    "calls": n_calls,
+                    "failed": failed,
+                    "throughput": throughput,
+                    "p50_ms": percentile(latencies, 50) * 1000.0,
+                    "p99_ms": percentile(latencies, 99) * 1000.0,
+                    "peak_kib": peak / 1024.0,
+                    "blocks": blocks,
+                    })
+    return results
+
+
+def print_results(results, out=sys.stdout):
+    header = ("mode", "method", "calls/s", "p50 ms", "p99 ms", "failed",
+              "peak KiB", "blocks")
+    row_format = "%-15s %-23s %10s %9s %9s %7s %9s %7s\n"
+    out.write(row_format % header)
+    for r in results:
+        out.write(row_format % (
+                r["mode"], r["method"], "%.0f" % r["throughput"],
+                "%.2f" % r["p50_ms"], "%.2f" % r["p99_ms"], r["failed"],
+                "%.1f" % r["peak_kib"], "%.0f" % r["blocks"]))
+
+
+def regressions(results, baseline, tolerance):
+    """Results with throughput more than `tolerance` (a fraction) below the
+    baseline's.
+    """
+    base = dict(((r["mode"], r["method"]), r) for r in baseline)
+    slower = []
+    for r in results:
+        b = base.get((r["mode"], r["method"]))
+        if b is not None and r["throughput"] < b["throughput"] * (1 - tolerance):
+            slower.append((r, b))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--calls", type=int, default=1000,
+                        help="calls per method and mode")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--distinct", type=int, default=100,
+                        help="number of distinct calls")
+    parser.add_argument("--alloc-calls", type=int, default=50,
+                        help="calls traced for allocations")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="mean server latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of responses that are errors")
+    parser.add_argument("--error-kind", choices=["geonames", "http"],
+                        default="geonames")
+    parser.add_argument("--payloads", help="directory of recorded responses")
+    parser.add_argument("--methods", nargs="+",
+                        default=["find_nearby_place", "find_nearby_toponym",
+                                 "find_nearby_wikipedia", "get_hierarchy",
+                                 "search"])
+    parser.add_argument("--modes", nargs="+",
+                        default=["default", "records", "response_cache",
+                                 "retry", "coalesce"])
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline",
+                        help="fail on regressions against these results")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed throughput drop against the baseline")
+    args = parser.parse_args(argv)
+
+    if args.payloads:
+        payloads = load_payloads(args.payloads)
+    else:
+        payloads = default_payloads()
+    process, base_url = start_server(payloads, args.latency / 1000.0,
+                                     args.error_rate, args.error_kind)
+    try:
+        results = benchmark(base_url, args.methods, args.modes, args.calls,
+                            args.threads, args.distinct, args.alloc_calls)
+    finally:
+        process.terminate()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.tolerance)
+        for r, b in slower:
+            sys.stderr.write("Regression: %s %s %.0f calls/s, was %.0f\n" % (
+                    r["mode"], r["method"], r["throughput"],
+                    b["throughput"]))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""asyncio client for the geonames.org web services.
+
+Requires Python 3 and `aiohttp <https://docs.aiohttp.org/>`_.
+"""
+
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from geogotchi.base import _check_weights
+from geogotchi.base import _geoname_id
+from geogotchi.base import _nearby_params
+from geogotchi.base import _parse_json
+from geogotchi.base import _search_params
+from geogotchi.constants import BASE_URL
+from geogotchi.constants import DEFAULT_USERNAME
+from geogotchi import errors
+from geogotchi import ranking
+from geogotchi import records
+
+
+class AsyncGeogotchi(object):
+    """Coroutine based version of :class:`geogotchi.Geogotchi`.
+
+    Methods take the same arguments as their :class:`geogotchi.Geogotchi`
+    counterparts. Use as an async context manager, or call :meth:`close`
+    when done.
+
+    :param username: geonames.org username.
+    :param session: An :class:`aiohttp.ClientSession` to use instead of
+                    creating one. A session passed in is not closed by
+                    :meth:`close`.
+    :param max_concurrency: Max number of requests in flight at once.
+    :param limit_per_host: Max number of connections per host.
+    :param records: Return geonames as compact
+                    :class:`geogotchi.records.Geoname` records instead of
+                    dicts.
+    :param base_url: URL of the web services, ending with a slash.
+    """
+
+    def __init__(self, username=DEFAULT_USERNAME, session=None,
+                 max_concurrency=100, limit_per_host=10, records=False,
+                 base_url=BASE_URL):
+        if session is None and aiohttp is None:
+            raise errors.GeogotchiError("AsyncGeogotchi requires aiohttp")
+        self._username = username
+        self._base_params = {
+                "username": self._username,
+                }
+        self._owns_session = session is None
+        self._session = session
+        self._max_concurrency = max_concurrency
+        self._limit_per_host = limit_per_host
+        self._semaphore = None
+        self._records = records
+        self._base_url = base_url
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close the HTTP session and release pooled connections.
+        """
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def find_nearby_place(self, latlon, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_place`.
+        """
+        return await self._find_nearby("findNearbyPlaceNameJSON", latlon,
+                                       **kwargs)
+
+    async def find_nearby_toponym(self, latlon, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_toponym`.
+        """
+        return await self._find_nearby("findNearbyJSON", latlon, **kwargs)
+
+    async def find_nearby_wikipedia(self, latlon, rank_weight=1.0,
+                                    distance_weight=1.0, top_k=None,
+                                    **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_wikipedia`.
+        """
+        rank_weight, distance_weight = _check_weights(rank_weight,
+                                                      distance_weight)
+        nearby = await self._find_nearby("findNearbyWikipediaJSON", latlon,
+                                         **kwargs)
+        return ranking.rank(nearby, rank_weight, distance_weight, top_k)
+
+    async def get_hierarchy(self, geoname):
+        """See :meth:`geogotchi.Geogotchi.get_hierarchy`.
+        """
+        params = self._base_params.copy()
+        params["geonameId"] = _geoname_id(geoname)
+        parsed_response = await self._request("hierarchyJSON", params)
+        return parsed_response["geonames"]
+
+    async def search(self, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.search`.
+        """
+        params = self._base_params.copy()
+        params.update(_search_params(kwargs))
+        parsed_response = await self._request("searchJSON", params)
+        return parsed_response["geonames"]
+
+    async def _find_nearby(self, path, latlon, **kwargs):
+        params = self._base_params.copy()
+        params.update(_nearby_params(latlon, kwargs))
+        parsed_response = await self._request(path, params)
+        return parsed_response["geonames"]
+
+    async def _request(self, path, params):
+        """Do a GET request against the API and parse the response.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                    limit=self._max_concurrency,
+                    limit_per_host=self._limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector)
+        url = self._base_url + path
+        async with self._semaphore:
+            async with self._session.get(url, params=params) as response:
+                body = await response.read()
+                status_code = response.status
+        parsed_response = _parse_json(status_code, body)
+        if self._records and "geonames" in parsed_response:
+            parsed_response["geonames"] = records.to_records(
+                    parsed_response["geonames"])
+        return parsed_response
@@ -18,15 +18,33 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
 import functools
-import math
-import json
+import threading
+from concurrent import futures
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    try:
+        from ujson import loads as _json_loads
+    except ImportError:
+        from json import loads as _json_loads
 
 import requests
+import requests.adapters
 
+from geogotchi.cache import NEGATIVE_ERRORS
+from geogotchi.cache import request_key
 from geogotchi.constants import BASE_URL
 from geogotchi.constants import DEFAULT_USERNAME
+from geogotchi.constants import MAX_SEARCH_ROWS
+from geogotchi.constants import MAX_SEARCH_START_ROW
 from geogotchi import errors
+from geogotchi import ranking
+from geogotchi import records
+from geogotchi import track
+from geogotchi.singleflight import SingleFlight
 
 
 def _latlon_params(latlon):
@@ -45,47 +63,299 @@ def _valid_weight(weight):
     return isinstance(weight, float) and 0.0 <= weight <= 1.0
 
 
-def _convert(convert_func, geonames, keys):
-    """Convert values in a list of geonames.
+# Numeric geoname fields the API returns as strings, and their types.
+_NUMERIC_FIELDS = [
+        ("distance", float),
+        ("lat", float),
+        ("lng", float),
+        ("population", int),
+        ("rank", int),
+        ]
+
+
+def _convert_numeric(geonames):
+    """Convert numeric values in a list of geonames, in place.
+
+    Values that do not parse, like empty strings, are left as they are.
 
-    :param convert_func: Function to run on key values.
     :param geonames: Parsed list of geonames returned from the API.
-    :param keys: List of keys that should be converted, if they exist
-                 in a geoname.
     :returns: The same list of geonames, with values converted.
     """
     for geoname in geonames:
-        for key in keys:
-            if key in geoname:
-                geoname[key] = convert_func(geoname[key])
+        for key, convert_func in _NUMERIC_FIELDS:
+            value = geoname.get(key)
+            if value is None or isinstance(value, (int, float)):
+                continue
+            try:
+                geoname[key] = convert_func(value)
+            except ValueError:
+                pass
     return geonames
 
-_convert_float = functools.partial(_convert, float)
 
+def _nearby_params(latlon, kwargs):
+    """Build request parameters for findNearby* API calls.
+
+    Consumes the keyword arguments it knows about from `kwargs`.
+    """
+    params = _latlon_params(latlon)
+
+    radius = kwargs.pop("radius", None)
+    if radius is not None:
+        params["radius"] = radius
+
+    max_rows = kwargs.pop("max_rows", None)
+    if max_rows is not None:
+        params["maxRows"] = max_rows
+
+    lang = kwargs.pop("lang", None)
+    if lang is not None:
+        params["lang"] = lang
 
-def _make_utf8(s):
-    if isinstance(s, unicode):
-        return s.encode("utf-8")
-    return s
+    params["style"] = kwargs.pop("style", "SHORT")
+    return params
 
 
-def _norm(V):
-    L = math.sqrt(sum([x**2 for x in V]))
-    if L == 0:
-        max_val = float(max(map(abs, V)))
-        if max_val == 0.0:
-            return [0.0 for x in V]
-        return [x/max_val for x in V]
-    return [x/L for x in V]
+def _search_params(kwargs):
+    """Build request parameters for searchJSON API calls.
+    """
+    params = {}
+    for kwarg_name, query_name, default, conv in [
+            ("q", "q", None, None),
+            ("name", "name", None, None),
+            ("name_equals", "name_equals", None, None),
+            ("max_rows", "maxRows", None, int),
+            ("start_row", "startRow", None, int),
+            ("country", "country", None, None),
+            ("country_bias", "countryBias", None, None),
+            ("continent_code", "continentCode", None, None),
+            ("feature_class", "featureClass", None, None),
+            ("feature_code", "featureCode", None, None),
+            ("lang", "lang", None, None),
+            ("style", "style", "SHORT", None),
+            ("operator", "operator", "AND", None),
+            ("fuzzy", "fuzzy", 1.0, float),
+            ]:
+        kwarg_val = kwargs.get(kwarg_name, default)
+        if kwarg_val is not None:
+            params[query_name] = kwarg_val if conv is None else conv(kwarg_val)
+    return params
+
+
+def _check_weights(rank_weight, distance_weight):
+    """Check that sorting weights are in range. Returns them as floats.
+    """
+    rank_weight = float(rank_weight)
+    distance_weight = float(distance_weight)
+    if not all(_valid_weight(w) for w in [rank_weight, distance_weight]):
+        raise errors.GeogotchiError("invalid sorting weight(s)")
+    return rank_weight, distance_weight
+
+
+def _parse_json(status_code, content):
+    """Parse a response body. Returns a Python structure or raises an
+    exception.
+
+    Numeric fields of geonames in the response are converted from strings.
+
+    :param content: Response body as UTF-8 encoded bytes.
+    """
+    if status_code != 200:
+        raise errors.HTTPError("status code: %s" % status_code, status_code)
+    parsed_response = _json_loads(content)
+    _maybe_raise_geoname_error(parsed_response)
+    if isinstance(parsed_response, dict):
+        geonames = parsed_response.get("geonames")
+        if isinstance(geonames, list):
+            _convert_numeric(geonames)
+    return parsed_response
+
+
+def _maybe_raise_geoname_error(parsed_response):
+    """Raises an exception if the parsed response looks like an error.
+
+    GeoName does not use HTTP status codes properly.
+    """
+    try:
+        status = parsed_response["status"]
+        error_code = status["value"]
+        message = status.get("message", "no message")
+    except TypeError:
+        pass
+    except KeyError:
+        pass
+    else:
+        error_class = errors.from_code(error_code)
+        raise error_class(message)
+
+
+# Result of one lookup in a batch call. `error` is the exception raised by
+# the lookup, in which case `geonames` is None.
+BatchResult = collections.namedtuple("BatchResult",
+                                     ["latlon", "geonames", "error"])
+
+
+def _batch_call(func, latlon, kwargs):
+    try:
+        return BatchResult(latlon, func(latlon, **kwargs), None)
+    except Exception as e:
+        return BatchResult(latlon, None, e)
+
+
+def map_batch(func, latlons, max_workers, kwargs):
+    """Call ``func(latlon, **kwargs)`` concurrently for each of `latlons`.
+    Returns a list of :class:`BatchResult`, in the same order.
+    """
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [executor.submit(_batch_call, func, latlon, kwargs)
+                   for latlon in latlons]
+        return [f.result() for f in pending]
+
+
+def _count_lookup(metrics, cache, path, cached):
+    # Records a cache lookup in a metrics registry.
+    if cached is None:
+        metrics.increment(cache + ".misses", path)
+    else:
+        metrics.increment(cache + ".hits", path)
+
+
+def _copy_response(parsed_response):
+    # Shallow copy of a response shared between coalesced calls, so callers
+    # can modify their geonames lists.
+    parsed_response = dict(parsed_response)
+    if "geonames" in parsed_response:
+        parsed_response["geonames"] = list(parsed_response["geonames"])
+    return parsed_response
+
+
+def _make_session(pool_connections, pool_maxsize, pool_block, keep_alive):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize,
+                                            pool_block=pool_block)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
 
 
 class Geogotchi(object):
+    """Client for the geonames.org web services.
+
+    HTTP requests go through a pooled :class:`requests.Session`, so
+    connections to the API are kept alive and reused between calls. The
+    client can be used as a context manager, which closes the session on
+    exit.
+
+    :param username: geonames.org username.
+    :param session: A :class:`requests.Session` to use instead of creating
+                    one. A session passed in is not closed by :meth:`close`.
+    :param pool_connections: Number of per-host connection pools to cache.
+    :param pool_maxsize: Max number of connections kept open per host.
+    :param pool_block: Block when all ``pool_maxsize`` connections to a host
+                       are in use instead of opening extra ones.
+    :param keep_alive: Reuse connections between requests.
+    :param records: Return geonames as compact
+                    :class:`geogotchi.records.Geoname` records instead of
+                    dicts.
+    :param nearby_cache: A :class:`geogotchi.cache.NearbyCache` used to
+                         answer findNearby* calls for points in already
+                         resolved grid cells without an API call.
+    :param hierarchy_cache: A :class:`geogotchi.cache.HierarchyCache` used
+                            to answer :meth:`get_hierarchy` for geonames in
+                            already fetched hierarchies.
+    :param response_cache: A :class:`geogotchi.cache.CacheBackend`, e.g. a
+                           :class:`geogotchi.cache.SQLiteCache`, caching
+                           responses of every API call.
+    :param rate_limiter: A :class:`geogotchi.ratelimit.RateLimiter` that
+                         every API call must get credits from.
+    :param retry_policy: A :class:`geogotchi.retry.RetryPolicy` for retrying
+                         API calls failing with transient errors.
+    :param timeout: Timeout in seconds of each HTTP request.
+    :param metrics: A :class:`geogotchi.metrics.Metrics` registry recording
+                    latencies, bytes, cache hits, retries and errors of
+                    API calls.
+    :param coalesce: Let concurrent identical API calls share a single
+                     HTTP request. Callers get their own result list, but
+                     the geonames in it are shared.
+    :param base_url: URL of the web services, ending with a slash.
+    :param negative_ttl: Seconds to cache responses meaning no result, e.g.
+                         :class:`geogotchi.errors.NoResultFound`, in
+                         `response_cache`. Not cached by default.
+    :param revalidate_workers: Max number of background threads refreshing
+                               stale responses of `response_cache`. Stale
+                               responses are served when the backend has a
+                               `stale_ttl`.
+    """
 
-    def __init__(self, username=DEFAULT_USERNAME):
+    def __init__(self, username=DEFAULT_USERNAME, session=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True, records=False, nearby_cache=None,
+                 hierarchy_cache=None, response_cache=None, rate_limiter=None,
+                 retry_policy=None, timeout=None, metrics=None,
+                 coalesce=False, base_url=BASE_URL, negative_ttl=None,
+                 revalidate_workers=2):
         self._username = username
         self._base_params = {
                 "username": self._username,
                 }
+        self._pool_maxsize = pool_maxsize
+        self._owns_session = session is None
+        if session is None:
+            session = _make_session(pool_connections, pool_maxsize,
+                                    pool_block, keep_alive)
+        self._session = session
+        self._records = records
+        self._nearby_cache = nearby_cache
+        self._hierarchy_cache = hierarchy_cache
+        self._response_cache = response_cache
+        self._rate_limiter = rate_limiter
+        self._retry_policy = retry_policy
+        self._timeout = timeout
+        self._metrics = metrics
+        self._base_url = base_url
+        self._flights = SingleFlight() if coalesce else None
+        self._negative_ttl = negative_ttl
+        self._revalidate_workers = revalidate_workers
+        self._revalidator = None
+        self._closed = False
+        self._revalidating = set()
+        self._revalidate_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def returns_records(self):
+        """Whether geonames are returned as
+        :class:`geogotchi.records.Geoname` records, see `records`.
+        """
+        return self._records
+
+    @property
+    def pool_maxsize(self):
+        """Max number of pooled connections, and the default number of
+        concurrent requests of batch calls.
+        """
+        return self._pool_maxsize
+
+    def close(self):
+        """Close the HTTP session and release pooled connections, after
+        waiting for background refreshes. Stale responses are no longer
+        refreshed afterwards.
+        """
+        with self._revalidate_lock:
+            self._closed = True
+            revalidator, self._revalidator = self._revalidator, None
+        if revalidator is not None:
+            revalidator.shutdown()
+        if self._owns_session:
+            self._session.close()
 
     def find_nearby_place(self, latlon, **kwargs):
         """Find nearby populated place (reverse geocoding).
@@ -112,7 +382,7 @@ class Geogotchi(object):
         return self._find_nearby("findNearbyJSON", latlon, **kwargs)
 
     def find_nearby_wikipedia(self, latlon, rank_weight=1.0, 
-                              distance_weight=1.0, **kwargs):
+                              distance_weight=1.0, top_k=None, **kwargs):
         """Find nearby Wikipedia entries (reverse geocoding).
 
         Does a "findNearbyWikipediaJSON" API call behind the scenes. Results
@@ -124,87 +394,237 @@ class Geogotchi(object):
         :param rank_weight: Weight of rank in sorting, between 0.0 and 1.0.
         :param distance_weight: Weight of distance in sorting, between 0.0 
                                 and 1.0.
+        :param top_k: Only return the `top_k` best entries.
         :param lang: Language code.
         """
-        # Check that sorting weights are in range.
-        rank_weight = float(rank_weight)
-        distance_weight = float(distance_weight)
-        if not all(_valid_weight(w) for w in [rank_weight, distance_weight]):
-            raise errors.GeogotchiError("invalid sorting weight(s)")
-
-        nearby = self._find_nearby("findNearbyWikipediaJSON", latlon, **kwargs)
-        ranks = _norm([entry["rank"] for entry in nearby])
-        dists = _norm([entry["distance"] for entry in nearby])
-        indexed = list(enumerate(nearby))
-        def score(x):
-            rank_score = rank_weight * ranks[x[0]]
-            dist_score = distance_weight * (1.0 - dists[x[0]])
-            return rank_score + dist_score
-        indexed.sort(key=score)
-        indexed.reverse()
-        return [x[1] for x in indexed]
+        rank_weight, distance_weight = _check_weights(rank_weight,
+                                                      distance_weight)
+        path = "findNearbyWikipediaJSON"
+        nearby = self._find_nearby(path, latlon, **kwargs)
+        metrics = self._metrics
+        if metrics is None:
+            return ranking.rank(nearby, rank_weight, distance_weight, top_k)
+        start = metrics.clock()
+        ranked = ranking.rank(nearby, rank_weight, distance_weight, top_k)
+        metrics.observe("ranking", path, metrics.clock() - start)
+        return ranked
+
+    def find_nearby_place_many(self, latlons, max_workers=None, **kwargs):
+        """Batch version of :meth:`find_nearby_place`.
+
+        Lookups are done concurrently. Returns a list of
+        :class:`BatchResult`, in the same order as `latlons`. A failed lookup
+        does not fail the batch, its exception is set on its result instead.
+
+        :param latlons: Iterable of latitude/longitude two-tuples.
+        :param max_workers: Max number of concurrent requests. Defaults to
+                            the connection pool size.
+        """
+        return self._many(self.find_nearby_place, latlons, max_workers,
+                          kwargs)
 
-    def _find_nearby(self, path, latlon, **kwargs):
-        # Used by findNearby* API calls.
-        params = self._base_params.copy()
-        params.update(_latlon_params(latlon))
+    def find_nearby_toponym_many(self, latlons, max_workers=None, **kwargs):
+        """Batch version of :meth:`find_nearby_toponym`.
+
+        See :meth:`find_nearby_place_many`.
+        """
+        return self._many(self.find_nearby_toponym, latlons, max_workers,
+                          kwargs)
 
-        radius = kwargs.pop("radius", None)
-        if radius is not None:
-            params["radius"] = radius
+    def find_nearby_wikipedia_many(self, latlons, max_workers=None,
+                                   **kwargs):
+        """Batch version of :meth:`find_nearby_wikipedia`.
 
-        max_rows = kwargs.pop("max_rows", None)
-        if max_rows is not None:
-            params["maxRows"] = max_rows
+        See :meth:`find_nearby_place_many`.
+        """
+        return self._many(self.find_nearby_wikipedia, latlons, max_workers,
+                          kwargs)
 
-        lang = kwargs.pop("lang", None)
-        if lang is not None:
-            params["lang"] = lang
+    def find_nearby_place_track(self, latlons, timestamps=None,
+                                threshold=track.DEFAULT_THRESHOLD,
+                                max_age=None, **kwargs):
+        """Find nearby populated places along a GPS track.
 
-        params["style"] = kwargs.pop("style", "SHORT")
-        url = BASE_URL + path
-        response = requests.get(url, params=params)
-        parsed_response = self._parse_response(response)
-        return _convert_float(parsed_response["geonames"], ["distance"])
+        Consecutive points reuse the previous result until the track moves
+        more than `threshold` km from the last looked up point, or the
+        lookup is older than `max_age`. Returns a list with the result of
+        each point, in the same order as `latlons`.
 
-    def _parse_response(self, response):
-        """Parse response. Returns a Python structure or raises an exception.
+        :param latlons: Latitude/longitude two-tuples, in track order.
+        :param timestamps: Optional timestamps in seconds, one per point.
+        :param threshold: Distance in km, see above.
+        :param max_age: Seconds, see above. Requires `timestamps`.
+
+        Other arguments are the same as for :meth:`find_nearby_place`.
         """
-        status_code = response.status_code
-        if status_code != 200:
-            raise errors.GeogotchiError("status code: %s" % status_code)
-        parsed_response = json.loads(response.text) 
-        self._maybe_raise_geoname_error(parsed_response)
-        return parsed_response
+        lookup = functools.partial(self.find_nearby_place, **kwargs)
+        return track.resolve_track(lookup, latlons, timestamps, threshold,
+                                   max_age)
 
-    def _maybe_raise_geoname_error(self, parsed_response):
-        """Raises an exception if the parsed response looks like an error.
+    def _many(self, func, latlons, max_workers, kwargs):
+        # Used by *_many API calls.
+        if max_workers is None:
+            max_workers = self.pool_maxsize
+        return map_batch(func, latlons, max_workers, kwargs)
 
-        GeoName does not use HTTP status codes properly.
+    def _find_nearby(self, path, latlon, **kwargs):
+        # Used by findNearby* API calls.
+        params = self._base_params.copy()
+        params.update(_nearby_params(latlon, kwargs))
+
+        cache = self._nearby_cache
+        if cache is not None:
+            cache_key = cache.key(path, latlon, params)
+            cached = cache.get(cache_key)
+            if self._metrics is not None:
+                _count_lookup(self._metrics, "nearby_cache", path, cached)
+            if cached is not None:
+                return cached
+
+        parsed_response = self._request(path, params)
+        geonames = parsed_response["geonames"]
+        if cache is not None:
+            cache.set(cache_key, geonames)
+        return geonames
+
+    def _request(self, path, params):
+        """Do a GET request against the API and parse the response.
         """
+        metrics = self._metrics
+        if metrics is None:
+            return self._fetch(path, params)
         try:
-            status = parsed_response["status"]
-            error_code = status["value"]
-            message = status.get("message", "no message")
-        except TypeError:
-            pass 
-        except KeyError:
+            return self._fetch(path, params)
+        except Exception as e:
+            metrics.increment("errors." + type(e).__name__, path)
+            raise
+
+    def _fetch(self, path, params):
+        # An API call, answered from the response cache if possible.
+        cache_key = None
+        if self._response_cache is not None:
+            cache_key = request_key(path, params)
+            entry = self._response_cache.get_stale(cache_key)
+            if self._metrics is not None:
+                _count_lookup(self._metrics, "response_cache", path, entry)
+            if entry is not None:
+                content, fresh = entry
+                if not fresh:
+                    self._revalidate(path, params, cache_key)
+                return self._parse_content(200, content)
+
+        if self._flights is None:
+            return self._call(path, params, cache_key)
+        call = functools.partial(self._call, path, params, cache_key)
+        parsed_response, shared = self._flights.do(
+                cache_key or request_key(path, params), call)
+        if shared:
+            parsed_response = _copy_response(parsed_response)
+        return parsed_response
+
+    def _revalidate(self, path, params, cache_key):
+        # Refresh a stale response in the background, once per key.
+        if self._metrics is not None:
+            self._metrics.increment("response_cache.stale", path)
+        with self._revalidate_lock:
+            if self._closed or cache_key in self._revalidating:
+                return
+            if self._revalidator is None:
+                self._revalidator = futures.ThreadPoolExecutor(
+                        max_workers=self._revalidate_workers)
+            self._revalidating.add(cache_key)
+            self._revalidator.submit(self._refresh, path, params, cache_key)
+
+    def _refresh(self, path, params, cache_key):
+        try:
+            self._call(path, params, cache_key)
+        except Exception:
+            # The stale response is served until it expires, and errors
+            # surface on the next call missing the cache.
             pass
+        finally:
+            with self._revalidate_lock:
+                self._revalidating.discard(cache_key)
+
+    def _call(self, path, params, cache_key):
+        # An API call, with retries.
+        send = functools.partial(self._send, path, params, cache_key)
+        if self._retry_policy is None:
+            return send(self._timeout)
+        on_retry = None
+        if self._metrics is not None:
+            on_retry = lambda e: self._metrics.increment("retries", path)
+        return self._retry_policy.call(send, self._timeout, on_retry)
+
+    def _send(self, path, params, cache_key, timeout):
+        # One attempt of an API call.
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire(path)
+        url = self._base_url + path
+        metrics = self._metrics
+        if metrics is None:
+            response = self._session.get(url, params=params, timeout=timeout)
+            parsed_response = self._parse_cached(response, cache_key)
         else:
-            error_class = errors.from_code(error_code)
-            raise error_class(message)
+            metrics.increment("requests", path)
+            start = metrics.clock()
+            response = self._session.get(url, params=params, timeout=timeout)
+            received = metrics.clock()
+            metrics.increment("bytes", path, len(response.content))
+            metrics.observe("network", path, received - start)
+            try:
+                parsed_response = self._parse_cached(response, cache_key)
+            finally:
+                metrics.observe("parse", path, metrics.clock() - received)
+        return parsed_response
+
+    def _parse_cached(self, response, cache_key):
+        # Parse a response, caching it if it is a result or, with a
+        # negative TTL, if it means there is no result.
+        try:
+            parsed_response = self._parse_response(response)
+        except NEGATIVE_ERRORS:
+            if cache_key is not None and self._negative_ttl is not None:
+                self._response_cache.set(cache_key, response.content,
+                                         ttl=self._negative_ttl)
+            raise
+        if cache_key is not None:
+            self._response_cache.set(cache_key, response.content)
+        return parsed_response
+
+    def _parse_response(self, response):
+        """Parse response. Returns a Python structure or raises an exception.
+        """
+        return self._parse_content(response.status_code, response.content)
+
+    def _parse_content(self, status_code, content):
+        parsed_response = _parse_json(status_code, content)
+        if self._records and "geonames" in parsed_response:
+            parsed_response["geonames"] = records.to_records(
+                    parsed_response["geonames"])
+        return parsed_response
 
     def get_hierarchy(self, geoname):
         """Returns all GeoNames higher up in the hierarchy of a place name. 
 
         :param geoname: A dict with a "geonameId" key or an integer.
         """
+        geoname_id = _geoname_id(geoname)
+        cache = self._hierarchy_cache
+        if cache is not None:
+            cached = cache.get(geoname_id)
+            if self._metrics is not None:
+                _count_lookup(self._metrics, "hierarchy_cache",
+                              "hierarchyJSON", cached)
+            if cached is not None:
+                return cached
+
         params = self._base_params.copy()
-        params["geonameId"] = _geoname_id(geoname)
+        params["geonameId"] = geoname_id
 
-        url = BASE_URL + "hierarchyJSON"
-        response = requests.get(url, params=params)
-        parsed_response = self._parse_response(response)
+        parsed_response = self._request("hierarchyJSON", params)
+        if cache is not None:
+            return cache.add(parsed_response["geonames"])
         return parsed_response["geonames"]
 
     def search(self, **kwargs):
@@ -235,26 +655,65 @@ class Geogotchi(object):
                       0.0 and 1.0 (default 1.0).
         """
         params = self._base_params.copy()
-        for kwarg_name, query_name, default, conv in [
-                ("q", "q", None, _make_utf8),
-                ("name", "name", None, _make_utf8),
-                ("name_equals", "name_equals", None, _make_utf8),
-                ("max_rows", "maxRows", None, int),
-                ("start_row", "startRow", None, int),
-                ("country", "country", None, _make_utf8),
-                ("country_bias", "countryBias", None, _make_utf8),
-                ("continent_code", "continentCode", None, _make_utf8),
-                ("feature_class", "featureClass", None, _make_utf8),
-                ("feature_code", "featureCode", None, _make_utf8),
-                ("lang", "lang", None, _make_utf8),
-                ("style", "style", "SHORT", _make_utf8),
-                ("operator", "operator", "AND", _make_utf8),
-                ("fuzzy", "fuzzy", 1.0, float),
-                ]:
-            kwarg_val = kwargs.get(kwarg_name, default)
-            if kwarg_val is not None:
-                params[query_name] = conv(kwarg_val)
-        url = BASE_URL + "searchJSON"
-        response = requests.get(url, params=params)
-        parsed_response = self._parse_response(response)
+        params.update(_search_params(kwargs))
+        parsed_response = self._request("searchJSON", params)
         return parsed_response["geonames"]
+
+    def iter_search(self, page_size=MAX_SEARCH_ROWS, prefetch=True, **kwargs):
+        """Iterate over search results across pages.
+
+        Takes the same arguments as :meth:`search`, with `max_rows` limiting
+        the total number of results instead of the page size. Pages are
+        requested as results are consumed, so memory use does not grow with
+        the number of results. The server caps how deep results can be
+        paged, see :data:`geogotchi.constants.MAX_SEARCH_START_ROW`.
+
+        :param page_size: Results per request, at most
+                          :data:`geogotchi.constants.MAX_SEARCH_ROWS`.
+        :param prefetch: Request the next page in a background thread while
+                         the current one is consumed.
+        """
+        page_size = max(1, min(int(page_size), MAX_SEARCH_ROWS))
+        start_row = int(kwargs.pop("start_row", None) or 0)
+        remaining = kwargs.pop("max_rows", None)
+        params = self._base_params.copy()
+        params.update(_search_params(kwargs))
+
+        def fetch(start, rows):
+            page_params = dict(params, startRow=start, maxRows=rows)
+            return self._request("searchJSON", page_params)
+
+        executor = None
+        if prefetch:
+            executor = futures.ThreadPoolExecutor(max_workers=1)
+
+        def request_page(start):
+            # Returns the page size and a function returning the page.
+            rows = page_size
+            if remaining is not None:
+                rows = min(rows, remaining)
+            if rows <= 0 or start > MAX_SEARCH_START_ROW:
+                return rows, None
+            if executor is not None:
+                return rows, executor.submit(fetch, start, rows).result
+            return rows, functools.partial(fetch, start, rows)
+
+        try:
+            rows, get_page = request_page(start_row)
+            while get_page is not None:
+                parsed_response = get_page()
+                geonames = parsed_response["geonames"]
+                total = parsed_response.get("totalResultsCount")
+                start_row += len(geonames)
+                if remaining is not None:
+                    remaining -= len(geonames)
+                if len(geonames) < rows or (total is not None and
+                                            start_row >= int(total)):
+                    get_page = None
+                else:
+                    rows, get_page = request_page(start_row)
+                for geoname in geonames:
+                    yield geoname
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
@@ -0,0 +1,394 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from requests.compat import urlencode
+
+from geogotchi import errors
+
+# Errors meaning that there is nothing to find, cached as negative results.
+NEGATIVE_ERRORS = (errors.NoResultFound,
+                   errors.RecordDoesNotExist,
+                   errors.PostalCodeNotFound)
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache with optional expiry.
+
+    :param max_size: Max number of entries. The least recently used entry
+                     is evicted when the cache is full.
+    :param ttl: Seconds an entry is kept, or ``None`` to keep entries until
+                they are evicted.
+    :param clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, max_size=10000, ttl=None, clock=time.time):
+        if max_size < 1:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the value for `key`, or `default` if missing or expired.
+        """
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= self._clock():
+                del self._entries[key]
+                return default
+            # Mark as most recently used.
+            del self._entries[key]
+            self._entries[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = self._clock() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class NearbyCache(object):
+    """Cache for reverse geocoding results, keyed by grid cell.
+
+    Coordinates are snapped to a grid of `resolution` degrees, so points
+    falling into the same cell share a cached result. Note that the
+    ``distance`` of a cached geoname is relative to the point that first
+    resolved the cell.
+
+    :param resolution: Grid cell size in degrees. 0.001 is roughly 110 m
+                       north-south.
+    :param max_size: Max number of cached cells.
+    :param ttl: Seconds a cached result is kept, or ``None``.
+    """
+
+    def __init__(self, resolution=0.001, max_size=10000, ttl=None,
+                 clock=time.time):
+        if resolution <= 0:
+            raise ValueError("resolution must be positive")
+        self.resolution = float(resolution)
+        self._lru = LRUCache(max_size=max_size, ttl=ttl, clock=clock)
+
+    def __len__(self):
+        return len(self._lru)
+
+    def cell(self, latlon):
+        """Grid cell of a latitude/longitude two-tuple.
+        """
+        return (int(math.floor(float(latlon[0]) / self.resolution)),
+                int(math.floor(float(latlon[1]) / self.resolution)))
+
+    def key(self, path, latlon, params):
+        """Cache key for a findNearby* call.
+
+        :param path: API path.
+        :param latlon: A latitude/longitude two-tuple.
+        :param params: Request parameters, only the ones affecting the
+                       result set are used.
+        """
+        return (path, self.cell(latlon), params.get("radius"),
+                params.get("maxRows"), params.get("style"),
+                params.get("lang"))
+
+    def get(self, key):
+        geonames = self._lru.get(key)
+        if geonames is None:
+            return None
+        return list(geonames)
+
+    def set(self, key, geonames):
+        self._lru.set(key, list(geonames))
+
+    def clear(self):
+        self._lru.clear()
+
+
+class HierarchyCache(object):
+    """Cache for :meth:`geogotchi.Geogotchi.get_hierarchy` results.
+
+    Each geoname is stored once, with a pointer to its parent, so places
+    sharing ancestors share the cached ancestor records. Any geoname seen in
+    a cached hierarchy, ancestors included, can be looked up without an API
+    call. Cached hierarchies contain the same dict objects across calls.
+
+    :param max_size: Max number of cached geonames.
+    :param ttl: Seconds a cached geoname is kept, or ``None``.
+    """
+
+    # Guards against cycles in corrupt data.
+    max_depth = 64
+
+    def __init__(self, max_size=100000, ttl=None, clock=time.time):
+        self._lru = LRUCache(max_size=max_size, ttl=ttl, clock=clock)
+
+    def __len__(self):
+        return len(self._lru)
+
+    def get(self, geoname_id):
+        """Cached hierarchy of `geoname_id`, or ``None``. A hierarchy with
+        any evicted or expired ancestor is a miss.
+        """
+        hierarchy = []
+        while geoname_id is not None:
+            entry = self._lru.get(geoname_id)
+            if entry is None or len(hierarchy) >= self.max_depth:
+                return None
+            geoname, geoname_id = entry
+            hierarchy.append(geoname)
+        hierarchy.reverse()
+        return hierarchy
+
+    def add(self, hierarchy):
+        """Cache a hierarchy. Returns it with already cached ancestors
+        replaced by their cached records.
+        """
+        shared = []
+        parent_id = None
+        for geoname in hierarchy:
+            geoname_id = geoname["geonameId"]
+            entry = self._lru.get(geoname_id)
+            if entry is not None and entry[1] == parent_id:
+                geoname = entry[0]
+            self._lru.set(geoname_id, (geoname, parent_id))
+            shared.append(geoname)
+            parent_id = geoname_id
+        return shared
+
+    def clear(self):
+        self._lru.clear()
+
+
+def request_key(path, params):
+    """Cache key of an API request.
+
+    Parameters are sorted, and the username is left out so that accounts
+    can share cached responses.
+    """
+    items = sorted((k, v) for k, v in params.items() if k != "username")
+    return "%s?%s" % (path, urlencode(items))
+
+
+class CacheBackend(object):
+    """Interface of response cache backends.
+
+    Backends map request keys from :func:`request_key` to raw response
+    bodies (bytes).
+    """
+
+    def get(self, key):
+        """Cached value of `key`, or ``None`` if missing or expired.
+        """
+        raise NotImplementedError
+
+    def get_stale(self, key):
+        """Cached value of `key` and whether it is fresh, as a tuple, or
+        ``None``. Backends keeping expired values for a while return them
+        as not fresh, the default is to only return fresh values.
+        """
+        value = self.get(key)
+        if value is None:
+            return None
+        return value, True
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` for `ttl` seconds, or the backend's default TTL.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+def _check_entry(value, expires, stale_ttl, now):
+    # (value, fresh) tuple of a cache entry, or None if past serving.
+    if expires is None or expires > now:
+        return value, True
+    if stale_ttl and expires + stale_ttl > now:
+        return value, False
+    return None
+
+
+class MemoryCache(CacheBackend):
+    """In-process response cache.
+
+    :param max_size: Max number of cached responses.
+    :param ttl: Default seconds a response is kept, or ``None``.
+    :param stale_ttl: Seconds an expired response is kept to be served
+                      while it is refreshed, see :meth:`get_stale`.
+    """
+
+    def __init__(self, max_size=10000, ttl=None, stale_ttl=0,
+                 clock=time.time):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._lru = LRUCache(max_size=max_size, clock=clock)
+
+    def get(self, key):
+        entry = self.get_stale(key)
+        if entry is None or not entry[1]:
+            return None
+        return entry[0]
+
+    def get_stale(self, key):
+        entry = self._lru.get(key)
+        if entry is None:
+            return None
+        return _check_entry(entry[0], entry[1], self.stale_ttl,
+                            self._clock())
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self._clock() + ttl
+        self._lru.set(key, (value, expires))
+
+    def clear(self):
+        self._lru.clear()
+
+
+class SQLiteCache(CacheBackend):
+    """Response cache in an SQLite database file.
+
+    Can be shared by any number of threads and processes on a host. The
+    database uses write-ahead logging, so readers do not block each other or
+    the writer.
+
+    :param path: Path of the database file.
+    :param ttl: Default seconds a response is kept, or ``None``.
+    :param max_size: Max number of cached responses. When exceeded, the
+                     responses closest to expiring, or oldest, are evicted.
+    :param timeout: Seconds to wait for a lock held by another process.
+    :param stale_ttl: Seconds an expired response is kept to be served
+                      while it is refreshed, see :meth:`get_stale`.
+    """
+
+    # Number of writes between checks of the cache size.
+    evict_every = 100
+
+    def __init__(self, path, ttl=None, max_size=100000, timeout=30.0,
+                 stale_ttl=0, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.timeout = timeout
+        self._clock = clock
+        self._local = threading.local()
+        self._writes = 0
+        self._execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                stored REAL NOT NULL,
+                expires REAL)""")
+        self._execute("""CREATE INDEX IF NOT EXISTS responses_eviction
+                ON responses (expires, stored)""")
+
+    def _connection(self):
+        # One connection per thread and process, connections can not be
+        # shared across either.
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, "pid", None) != pid:
+            local.connection = sqlite3.connect(self.path,
+                                               timeout=self.timeout,
+                                               isolation_level=None)
+            local.connection.execute("PRAGMA journal_mode=WAL")
+            local.pid = pid
+        return local.connection
+
+    def _execute(self, sql, args=()):
+        return self._connection().execute(sql, args)
+
+    def get(self, key):
+        entry = self.get_stale(key)
+        if entry is None or not entry[1]:
+            return None
+        return entry[0]
+
+    def get_stale(self, key):
+        row = self._execute(
+                "SELECT value, expires FROM responses WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        return _check_entry(bytes(row[0]), row[1], self.stale_ttl,
+                            self._clock())
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        now = self._clock()
+        expires = None if ttl is None else now + ttl
+        self._execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                      (key, sqlite3.Binary(value), now, expires))
+        self._writes += 1
+        if self._writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """Delete expired responses past `stale_ttl`, then the responses
+        closest to expiring until the cache fits `max_size`.
+        """
+        self._execute("DELETE FROM responses WHERE expires <= ?",
+                      (self._clock() - self.stale_ttl,))
+        count, = self._execute("SELECT COUNT(*) FROM responses").fetchone()
+        excess = count - self.max_size
+        if excess > 0:
+            # Responses that never expire go last.
+            self._execute("""DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses
+                    ORDER BY expires IS NULL, expires, stored LIMIT ?)""",
+                          (excess,))
+
+    def clear(self):
+        self._execute("DELETE FROM responses")
+
+    def close(self):
+        """Close the calling thread's connection.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+            self._local.pid = None
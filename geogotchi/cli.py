@@ -0,0 +1,366 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Bulk reverse geocoding of CSV or JSON lines files.
+
+Reads rows with coordinates, looks them up concurrently and writes one JSON
+object per row, the input fields plus ``row`` (the input row number),
+``geonames`` and optionally ``hierarchy``, or ``error`` if the lookup
+failed::
+
+    $ geogotchi-bulk points.csv places.jsonl --username me --workers 16 \\
+          --hierarchy --checkpoint places.checkpoint
+
+Input is streamed, with at most ``--window`` rows in flight, so memory use
+does not grow with the input size. With ``--checkpoint``, progress is saved
+as rows are written, and a rerun with the same arguments resumes where an
+interrupted run stopped.
+"""
+
+import argparse
+import collections
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent import futures
+
+from geogotchi import Geogotchi
+from geogotchi.retry import RetryPolicy
+
+# Client of the current process, created by _init_worker.
+_resolver = None
+_options = None
+
+
+def _make_resolver(options):
+    client = Geogotchi(username=options["username"],
+                       pool_maxsize=options["workers"],
+                       retry_policy=RetryPolicy(
+                           max_attempts=options["retries"]),
+                       timeout=options["timeout"])
+    if options["local"] is None:
+        return client
+    from geogotchi.local import LocalGeonames
+    from geogotchi.resolver import TieredResolver
+    return TieredResolver(client, local=LocalGeonames.open(options["local"]))
+
+
+def _init_worker(options):
+    global _resolver, _options
+    _options = options
+    _resolver = _make_resolver(options)
+
+
+def _geocode(row, record):
+    """Look up one input row. Returns its output line.
+    """
+    options = _options
+    if isinstance(record, ValueError):
+        result = {"row": row, "error": "%s: %s" % (type(record).__name__,
+                                                   record)}
+        return json.dumps(result, separators=(",", ":")) + "\n"
+    result = dict(record)
+    result["row"] = row
+    try:
+        latlon = (float(record[options["lat"]]),
+                  float(record[options["lng"]]))
+        method = getattr(_resolver, options["method"])
+        geonames = method(latlon, **options["kwargs"])
+        result["geonames"] = geonames
+        if options["hierarchy"] and geonames:
+            result["hierarchy"] = _resolver.get_hierarchy(geonames[0])
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return json.dumps(result, separators=(",", ":")) + "\n"
+
+
+def _decode_line(line):
+    # JSON object of an input line, or the ValueError decoding it.
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        return e
+    if not isinstance(record, dict):
+        return ValueError("not a JSON object")
+    return record
+
+
+def read_rows(f, input_format):
+    """Rows of an input file, as dicts. Invalid JSON lines are read as the
+    ValueError decoding them, and written as rows with an ``error``.
+    """
+    if input_format == "csv":
+        return csv.DictReader(f)
+    return (_decode_line(line) for line in f if line.strip())
+
+
+def input_source(path, input_format):
+    """Identifies an input file in checkpoints: its path, size and format.
+    """
+    if path == "-":
+        return {"path": path, "size": None, "format": input_format}
+    return {"path": os.path.abspath(path), "size": os.path.getsize(path),
+            "format": input_format}
+
+
+class Checkpoint(object):
+    """Number of input rows done and the output size after them, saved
+    atomically to a file.
+
+    :param source: The input, from :func:`input_source`. Loading a
+                   checkpoint of another input raises ``ValueError``.
+    """
+
+    def __init__(self, path, source=None):
+        self.path = path
+        self.source = source
+
+    def load(self):
+        try:
+            with io.open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except IOError:
+            return 0, 0
+        if state.get("source") != self.source:
+            raise ValueError("checkpoint %s is of another input: %s" % (
+                    self.path, state.get("source")))
+        return state["rows"], state["offset"]
+
+    def save(self, rows, offset):
+        tmp_path = self.path + ".tmp"
+        state = {"rows": rows, "offset": offset, "source": self.source}
+        with io.open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class Progress(object):
+    """Reports rows written and rows per second.
+    """
+
+    def __init__(self, out, interval, done=0, clock=time.time):
+        self.out = out
+        self.interval = interval
+        self.done = done
+        self._clock = clock
+        self._start = self._last = clock()
+        self._last_done = done
+        self._started_at = done
+
+    def update(self, n=1):
+        self.done += n
+        if self.out is None:
+            return
+        now = self._clock()
+        if now - self._last >= self.interval:
+            rate = (self.done - self._last_done) / (now - self._last)
+            self.out.write("%d rows, %.0f rows/s\n" % (self.done, rate))
+            self.out.flush()
+            self._last = now
+            self._last_done = self.done
+
+    def finish(self):
+        if self.out is None:
+            return
+        elapsed = max(self._clock() - self._start, 1e-9)
+        self.out.write("%d rows, %.0f rows/s overall\n" % (
+                self.done, (self.done - self._started_at) / elapsed))
+
+
+class Writer(object):
+    """Writes output lines, saving a checkpoint every `every` rows.
+    """
+
+    def __init__(self, f, checkpoint, rows, every):
+        self.f = f
+        self.checkpoint = checkpoint
+        self.rows = rows
+        self.every = every
+
+    def write(self, line):
+        self.f.write(line.encode("utf-8"))
+        self.rows += 1
+        if self.checkpoint is not None and self.rows % self.every == 0:
+            self.save()
+
+    def save(self):
+        self.f.flush()
+        if self.checkpoint is not None:
+            os.fsync(self.f.fileno())
+            self.checkpoint.save(self.rows, self.f.tell())
+
+
+def run(rows, writer, executor, window, ordered, progress):
+    """Geocode `rows`, an iterable of (row number, record) tuples, writing
+    results as they complete. In order, unless `ordered` is false.
+    """
+    if ordered:
+        pending = collections.deque()
+        for row, record in rows:
+            pending.append(executor.submit(_geocode, row, record))
+            if len(pending) >= window:
+                writer.write(pending.popleft().result())
+                progress.update()
+        while pending:
+            writer.write(pending.popleft().result())
+            progress.update()
+        return
+    pending = set()
+    for row, record in rows:
+        pending.add(executor.submit(_geocode, row, record))
+        if len(pending) >= window:
+            done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                writer.write(future.result())
+                progress.update()
+    for future in futures.as_completed(pending):
+        writer.write(future.result())
+        progress.update()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+            description="Bulk reverse geocoding of CSV or JSON lines files.")
+    parser.add_argument("input", help="input file, or - for stdin")
+    parser.add_argument("output", help="output file, or - for stdout")
+    parser.add_argument("--input-format", choices=["csv", "jsonl"],
+                        help="defaults to the input file extension")
+    parser.add_argument("--lat", default="lat", help="latitude field")
+    parser.add_argument("--lng", default="lng", help="longitude field")
+    parser.add_argument("--method", default="find_nearby_place",
+                        choices=["find_nearby_place", "find_nearby_toponym"])
+    parser.add_argument("--radius", type=float)
+    parser.add_argument("--max-rows", type=int)
+    parser.add_argument("--hierarchy", action="store_true",
+                        help="add the hierarchy of the first geoname")
+    parser.add_argument("--username", default="demo")
+    parser.add_argument("--local", metavar="STORE",
+                        help="answer from this LocalGeonames store first")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--processes", action="store_true",
+                        help="use processes instead of threads")
+    parser.add_argument("--window", type=int,
+                        help="max rows in flight, default 4 per worker")
+    parser.add_argument("--unordered", action="store_true",
+                        help="write rows as they complete")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="max attempts per lookup")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--checkpoint", help="checkpoint file")
+    parser.add_argument("--checkpoint-every", type=int, default=1000)
+    parser.add_argument("--progress-interval", type=float, default=5.0)
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+    if args.checkpoint is not None:
+        if args.unordered:
+            parser.error("--checkpoint requires ordered output")
+        if args.output == "-":
+            parser.error("--checkpoint requires an output file")
+    if args.input_format is None:
+        is_csv = args.input.lower().endswith(".csv")
+        args.input_format = "csv" if is_csv else "jsonl"
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    kwargs = {}
+    if args.radius is not None:
+        kwargs["radius"] = args.radius
+    if args.max_rows is not None:
+        kwargs["max_rows"] = args.max_rows
+    options = {
+            "username": args.username,
+            "workers": args.workers,
+            "retries": args.retries,
+            "timeout": args.timeout,
+            "local": args.local,
+            "lat": args.lat,
+            "lng": args.lng,
+            "method": args.method,
+            "kwargs": kwargs,
+            "hierarchy": args.hierarchy,
+            }
+
+    log = None if args.quiet else sys.stderr
+    checkpoint = None
+    done, offset = 0, 0
+    if args.checkpoint is not None:
+        checkpoint = Checkpoint(args.checkpoint,
+                                input_source(args.input, args.input_format))
+        try:
+            done, offset = checkpoint.load()
+        except ValueError as e:
+            sys.stderr.write("geogotchi-bulk: %s\n" % e)
+            return 1
+        if done and not os.path.exists(args.output):
+            if log is not None:
+                log.write("%s is missing, starting over\n" % args.output)
+            done, offset = 0, 0
+
+    if args.input == "-":
+        f_in = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8",
+                                newline="")
+    else:
+        f_in = io.open(args.input, encoding="utf-8", newline="")
+    if args.output == "-":
+        f_out = sys.stdout.buffer
+    elif done:
+        # Drop output written after the checkpoint.
+        f_out = io.open(args.output, "r+b")
+        f_out.truncate(offset)
+        f_out.seek(offset)
+    else:
+        f_out = io.open(args.output, "wb")
+
+    if args.processes:
+        executor = futures.ProcessPoolExecutor(
+                max_workers=args.workers, initializer=_init_worker,
+                initargs=(options,))
+    else:
+        _init_worker(options)
+        executor = futures.ThreadPoolExecutor(max_workers=args.workers)
+
+    rows = enumerate(read_rows(f_in, args.input_format))
+    rows = itertools.islice(rows, done, None)
+    writer = Writer(f_out, checkpoint, done, args.checkpoint_every)
+    progress = Progress(log, args.progress_interval, done)
+    window = args.window or 4 * args.workers
+    try:
+        with executor:
+            run(rows, writer, executor, window, not args.unordered, progress)
+    finally:
+        writer.save()
+        progress.finish()
+        f_in.close()
+        if f_out is not sys.stdout.buffer:
+            f_out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
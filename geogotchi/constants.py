@@ -21,3 +21,7 @@
 # HTTPS seems unsupported.
 BASE_URL = "http://api.geonames.org/"
 DEFAULT_USERNAME = "demo"
+
+# Paging limits of searchJSON.
+MAX_SEARCH_ROWS = 1000
+MAX_SEARCH_START_ROW = 5000
@@ -20,6 +20,8 @@
 
 class GeogotchiError(Exception): pass
 class GeonamesError(GeogotchiError): pass
+class RateLimitExceeded(GeogotchiError): pass
+class ReplayMiss(GeogotchiError): pass
 class AuthorizationException(GeonamesError): pass
 class RecordDoesNotExist(GeonamesError): pass
 class OtherError(GeonamesError): pass
@@ -35,6 +37,15 @@ class InvalidInput(GeonamesError): pass
 class ServerOverloadedException(GeonamesError): pass
 class ServiceNotImplemented(GeonamesError): pass
 
+class HTTPError(GeogotchiError):
+    """Raised when the API responds with a status code other than 200.
+    """
+
+    def __init__(self, message, status_code=None):
+        super(HTTPError, self).__init__(message)
+        self.status_code = status_code
+
+
 _geonames_error_order = [AuthorizationException, RecordDoesNotExist, OtherError, 
                          DatabaseTimeout, InvalidParameter, NoResultFound, 
                          DuplicateException, PostalCodeNotFound, 
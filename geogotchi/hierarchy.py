@@ -0,0 +1,252 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Offline hierarchy resolution from GeoNames ``hierarchy.txt`` and admin
+code files.
+"""
+
+import array
+
+from geogotchi.base import _geoname_id
+from geogotchi.cache import LRUCache
+from geogotchi.local import _open_text
+from geogotchi import errors
+
+EARTH_ID = 6295630
+
+CONTINENT_IDS = {
+        "AF": 6255146,
+        "AS": 6255147,
+        "EU": 6255148,
+        "NA": 6255149,
+        "SA": 6255150,
+        "OC": 6255151,
+        "AN": 6255152,
+        }
+
+_NO_PARENT = -1
+
+
+def _read_tsv(source):
+    with _open_text(source) as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            yield line.rstrip("\n").split("\t")
+
+
+def read_hierarchy(source):
+    """Read ``hierarchy.txt``. Returns a dict mapping child ids to parent
+    ids, preferring administrative (ADM) parents.
+    """
+    parents = {}
+    for fields in _read_tsv(source):
+        parent_id, child_id = int(fields[0]), int(fields[1])
+        is_adm = len(fields) > 2 and fields[2] == "ADM"
+        if child_id not in parents or is_adm:
+            parents[child_id] = parent_id
+    return parents
+
+
+def read_admin_codes(source):
+    """Read ``admin1CodesASCII.txt`` or ``admin2Codes.txt``. Returns a dict
+    mapping codes like ``"SE.16"`` to geoname ids.
+    """
+    return dict((fields[0], int(fields[3])) for fields in _read_tsv(source))
+
+
+def read_country_info(source):
+    """Read ``countryInfo.txt``. Returns a dict mapping ISO country codes to
+    (geoname id, continent code) tuples.
+    """
+    return dict((fields[0], (int(fields[16]), fields[8]))
+                for fields in _read_tsv(source))
+
+
+class LocalHierarchy(object):
+    """Hierarchy resolution without API calls.
+
+    Parents are kept as an array of row indexes into a
+    :class:`geogotchi.local.LocalGeonames` store. Rows missing from
+    ``hierarchy.txt`` get their parent from their admin codes instead:
+    admin2, admin1, country, continent and finally Earth. Ancestor chains
+    are memoized, so chains shared between places are resolved once.
+
+    :param store: A :class:`geogotchi.local.LocalGeonames`.
+    :param hierarchy: Dict from :func:`read_hierarchy`.
+    :param admin1_codes: Dict from :func:`read_admin_codes`. Defaults to the
+                         ADM1 rows of `store`.
+    :param admin2_codes: Dict from :func:`read_admin_codes`. Defaults to the
+                         ADM2 rows of `store`.
+    :param country_info: Dict from :func:`read_country_info`. Defaults to
+                         the PCL* rows of `store`, without continents.
+    :param max_chains: Max number of memoized ancestor chains.
+    """
+
+    def __init__(self, store, hierarchy=None, admin1_codes=None,
+                 admin2_codes=None, country_info=None, max_chains=100000):
+        self._store = store
+        self._chains = LRUCache(max_size=max_chains)
+        self._links = hierarchy or {}
+        all_codes = [store.codes(row) for row in range(len(store))]
+        if None in (admin1_codes, admin2_codes, country_info):
+            found = self._find_admin_codes(all_codes)
+            admin1_codes = found[0] if admin1_codes is None else admin1_codes
+            admin2_codes = found[1] if admin2_codes is None else admin2_codes
+            country_info = found[2] if country_info is None else country_info
+        self._admin1_codes = admin1_codes
+        self._admin2_codes = admin2_codes
+        self._country_info = country_info
+        self._parents = self._build_parents(all_codes)
+
+    @classmethod
+    def from_files(cls, store, hierarchy_path, admin1_path=None,
+                   admin2_path=None, country_info_path=None, **kwargs):
+        """Build a hierarchy from GeoNames dump files.
+        """
+        return cls(store, read_hierarchy(hierarchy_path),
+                   admin1_path and read_admin_codes(admin1_path),
+                   admin2_path and read_admin_codes(admin2_path),
+                   country_info_path and read_country_info(country_info_path),
+                   **kwargs)
+
+    def _find_admin_codes(self, all_codes):
+        # Admin code and country dicts from the ADM1, ADM2 and PCL* rows.
+        store = self._store
+        admin1_codes, admin2_codes, country_info = {}, {}, {}
+        for row, codes in enumerate(all_codes):
+            _, fcode, country, admin1, admin2 = codes
+            geoname_id = store.geoname_id(row)
+            if fcode == "ADM1":
+                admin1_codes["%s.%s" % (country, admin1)] = geoname_id
+            elif fcode == "ADM2":
+                code = "%s.%s.%s" % (country, admin1, admin2)
+                admin2_codes[code] = geoname_id
+            elif fcode.startswith("PCL"):
+                country_info[country] = (geoname_id, None)
+        return admin1_codes, admin2_codes, country_info
+
+    def parent_ids(self, geoname_id, codes):
+        """Candidate parent ids of a geoname, best first: its parent in
+        ``hierarchy.txt``, then parents by admin codes.
+
+        :param codes: Codes of the geoname, as returned by
+                      :meth:`geogotchi.local.LocalGeonames.codes`.
+        """
+        _, fcode, country, admin1, admin2 = codes
+        if geoname_id == EARTH_ID:
+            return []
+        candidates = [self._links.get(geoname_id)]
+        country_id, continent = self._country_info.get(country, (None, None))
+        if fcode == "CONT":
+            candidates.append(EARTH_ID)
+        elif fcode.startswith("PCL"):
+            candidates.append(CONTINENT_IDS.get(continent))
+        else:
+            if fcode != "ADM2":
+                candidates.append(self._admin2_codes.get(
+                        "%s.%s.%s" % (country, admin1, admin2)))
+            if fcode != "ADM1":
+                candidates.append(self._admin1_codes.get(
+                        "%s.%s" % (country, admin1)))
+            candidates.append(country_id)
+        return [parent_id for parent_id in candidates
+                if parent_id is not None and parent_id != geoname_id]
+
+    def _build_parents(self, all_codes):
+        store = self._store
+        parents = array.array("q", [_NO_PARENT]) * len(all_codes)
+        for row, codes in enumerate(all_codes):
+            for parent_id in self.parent_ids(store.geoname_id(row), codes):
+                parent_row = store.row(parent_id)
+                if parent_row is not None:
+                    parents[row] = parent_row
+                    break
+        return parents
+
+    def parent(self, row):
+        """Parent row of `row`, or ``None``.
+        """
+        parent = self._parents[row]
+        return None if parent == _NO_PARENT else parent
+
+    def chain(self, row):
+        """Rows from the root down to `row`, as a tuple.
+        """
+        chain = self._chains.get(row)
+        if chain is not None:
+            return chain
+        # Walk up until a memoized ancestor or the root, then memoize the
+        # chain of every row passed on the way down.
+        path = []
+        seen = set()
+        parent_chain = ()
+        while row != _NO_PARENT and row not in seen:
+            cached = self._chains.get(row)
+            if cached is not None:
+                parent_chain = cached
+                break
+            seen.add(row)
+            path.append(row)
+            row = self._parents[row]
+        chain = parent_chain
+        for row in reversed(path):
+            chain = chain + (row,)
+            self._chains.set(row, chain)
+        return chain
+
+    def get_hierarchy(self, geoname):
+        """Same as :meth:`geogotchi.Geogotchi.get_hierarchy`, without API
+        calls.
+
+        The hierarchy stops at the highest ancestor in the store, so it is
+        truncated when the store lacks ancestors, e.g. a ``cities1000.txt``
+        store without countries or the continents and Earth.
+
+        :param geoname: A dict with a "geonameId" key or an integer.
+        """
+        geoname_id = _geoname_id(geoname)
+        row = self._store.row(geoname_id)
+        if row is None:
+            raise errors.RecordDoesNotExist(
+                    "no geoname with id %s" % geoname_id)
+        return [self._store.record(r) for r in self.chain(row)]
+
+    def get_hierarchies(self, geonames):
+        """Hierarchies of many geonames at once, in the same order.
+
+        Places sharing ancestors, and repeated places, are resolved once.
+        Shared ancestors are the same dict objects in every hierarchy.
+        """
+        records = {}
+        hierarchies = []
+        for geoname in geonames:
+            geoname_id = _geoname_id(geoname)
+            row = self._store.row(geoname_id)
+            if row is None:
+                raise errors.RecordDoesNotExist(
+                        "no geoname with id %s" % geoname_id)
+            hierarchy = []
+            for r in self.chain(row):
+                if r not in records:
+                    records[r] = self._store.record(r)
+                hierarchy.append(records[r])
+            hierarchies.append(hierarchy)
+        return hierarchies
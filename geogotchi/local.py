@@ -0,0 +1,466 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Offline reverse geocoding from a GeoNames dump.
+
+Dumps are the tab separated ``allCountries.txt``/``cities*.txt`` files from
+http://download.geonames.org/export/dump/.
+"""
+
+import array
+import bisect
+import heapq
+import io
+import json
+import math
+import mmap
+import struct
+import sys
+
+from geogotchi import geo
+
+# Column order of the GeoNames "geoname" table dump.
+(_ID, _NAME, _ASCIINAME, _ALTERNATENAMES, _LAT, _LNG, _FCL, _FCODE, _COUNTRY,
+ _CC2, _ADMIN1, _ADMIN2, _ADMIN3, _ADMIN4, _POPULATION, _ELEVATION, _DEM,
+ _TIMEZONE, _MODIFIED) = range(19)
+
+# Numeric columns of a store and their array type codes.
+NUMERIC_COLUMNS = [
+        ("ids", "q"),
+        ("lats", "d"),
+        ("lngs", "d"),
+        ("xs", "d"),
+        ("ys", "d"),
+        ("zs", "d"),
+        ("populations", "q"),
+        ("features", "I"),
+        ("countries", "I"),
+        ("admin1s", "I"),
+        ("admin2s", "I"),
+        ("name_offsets", "q"),
+        ("sorted_ids", "q"),
+        ("id_rows", "q"),
+        ]
+
+# Low cardinality string columns, stored as indexes into a string table.
+TABLE_COLUMNS = [
+        ("features", "feature"),
+        ("countries", "country"),
+        ("admin1s", "admin1"),
+        ("admin2s", "admin2"),
+        ]
+
+
+# Binary store file layout: magic, header length, JSON header, then each
+# column and the name blob at 8 byte aligned offsets given in the header.
+MAGIC = b"GEOGOTCHI-STORE-1"
+_HEADER_LENGTH = struct.Struct("<Q")
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _open_text(source):
+    if hasattr(source, "read"):
+        return source
+    return io.open(source, encoding="utf-8")
+
+
+class _Builder(object):
+    # Accumulates dump rows into columns.
+
+    def __init__(self):
+        self.columns = dict((name, array.array(code))
+                            for name, code in NUMERIC_COLUMNS)
+        self.tables = dict((name, []) for name, _ in TABLE_COLUMNS)
+        self._interned = dict((name, {}) for name, _ in TABLE_COLUMNS)
+        self.names = []
+
+    def _intern(self, column, value):
+        interned = self._interned[column]
+        try:
+            return interned[value]
+        except KeyError:
+            interned[value] = index = len(interned)
+            self.tables[column].append(value)
+            return index
+
+    def add(self, fields):
+        lat = float(fields[_LAT])
+        lng = float(fields[_LNG])
+        x, y, z = geo.to_xyz((lat, lng))
+        columns = self.columns
+        columns["ids"].append(int(fields[_ID]))
+        columns["lats"].append(lat)
+        columns["lngs"].append(lng)
+        columns["xs"].append(x)
+        columns["ys"].append(y)
+        columns["zs"].append(z)
+        columns["populations"].append(int(fields[_POPULATION] or 0))
+        feature = "%s.%s" % (fields[_FCL], fields[_FCODE])
+        columns["features"].append(self._intern("features", feature))
+        columns["countries"].append(self._intern("countries",
+                                                 fields[_COUNTRY]))
+        columns["admin1s"].append(self._intern("admin1s", fields[_ADMIN1]))
+        columns["admin2s"].append(self._intern("admin2s", fields[_ADMIN2]))
+        self.names.append(fields[_NAME])
+
+    def build(self):
+        """Reorder rows into k-d tree order and build lookup columns.
+        """
+        columns = self.columns
+        order = _kd_order(columns["xs"], columns["ys"], columns["zs"])
+        for name, code in NUMERIC_COLUMNS:
+            column = columns[name]
+            if len(column):
+                columns[name] = array.array(code, [column[i] for i in order])
+
+        encoded = [self.names[i].encode("utf-8") for i in order]
+        offsets = columns["name_offsets"]
+        offset = 0
+        for name in encoded:
+            offsets.append(offset)
+            offset += len(name)
+        offsets.append(offset)
+
+        ids = columns["ids"]
+        id_rows = sorted(range(len(ids)), key=ids.__getitem__)
+        columns["id_rows"] = array.array("q", id_rows)
+        columns["sorted_ids"] = array.array("q", [ids[i] for i in id_rows])
+        return columns, self.tables, b"".join(encoded)
+
+
+def _kd_order(xs, ys, zs):
+    """Row order of an implicit k-d tree over unit sphere points.
+
+    The tree over rows ``[lo, hi)`` has its root at ``(lo + hi) // 2``,
+    splitting on axis ``depth % 3``, and its subtrees to either side.
+    """
+    axes = (xs, ys, zs)
+    order = list(range(len(xs)))
+    stack = [(0, len(order), 0)]
+    while stack:
+        lo, hi, depth = stack.pop()
+        if hi - lo <= 1:
+            continue
+        segment = order[lo:hi]
+        segment.sort(key=axes[depth % 3].__getitem__)
+        order[lo:hi] = segment
+        mid = (lo + hi) // 2
+        stack.append((lo, mid, depth + 1))
+        stack.append((mid + 1, hi, depth + 1))
+    return order
+
+
+class LocalGeonames(object):
+    """Reverse geocoder answering from a GeoNames dump in memory.
+
+    Rows are kept in compact typed arrays, ordered as an implicit k-d tree
+    over points on the unit sphere. Use :meth:`from_dump` to load a dump,
+    or :meth:`open` to memory-map a store written by :meth:`save`.
+
+    :meth:`find_nearby_place` and :meth:`find_nearby_toponym` return the
+    same shape as :class:`geogotchi.Geogotchi`, with a ``distance`` in km.
+    """
+
+    def __init__(self, columns, tables, names, buffer=None):
+        for name, _ in NUMERIC_COLUMNS:
+            setattr(self, "_" + name, columns[name])
+        self._tables = tables
+        self._names = names
+        self._buffer = buffer
+        self._populated = frozenset(
+                i for i, feature in enumerate(tables["features"])
+                if feature.startswith("P."))
+
+    @classmethod
+    def from_dump(cls, source, feature_classes=None):
+        """Load a GeoNames dump.
+
+        :param source: Path or text file object of the dump.
+        :param feature_classes: Only load rows of these feature classes,
+                                e.g. ``"PAL"``. Defaults to all rows.
+        """
+        builder = _Builder()
+        with _open_text(source) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 19 or line.startswith("#"):
+                    continue
+                if (feature_classes is not None and
+                        fields[_FCL] not in feature_classes):
+                    continue
+                builder.add(fields)
+        return cls(*builder.build())
+
+    @classmethod
+    def open(cls, path):
+        """Memory-map a store file written by :meth:`save`.
+
+        Columns are read straight from the mapped file, so opening is fast
+        and processes mapping the same file share its pages. Call
+        :meth:`close` when done.
+        """
+        with io.open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if buf[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a geogotchi store" % path)
+            offset = len(MAGIC)
+            header_length, = _HEADER_LENGTH.unpack_from(buf, offset)
+            offset += _HEADER_LENGTH.size
+            header = json.loads(
+                    buf[offset:offset + header_length].decode("utf-8"))
+            if header["byteorder"] != sys.byteorder:
+                raise ValueError("%s has byte order %s"
+                                 % (path, header["byteorder"]))
+            view = memoryview(buf)
+            columns = {}
+            for name, code in NUMERIC_COLUMNS:
+                start, nbytes = header["columns"][name]
+                columns[name] = view[start:start + nbytes].cast(code)
+            start, nbytes = header["names"]
+            names = view[start:start + nbytes]
+        except Exception:
+            buf.close()
+            raise
+        return cls(columns, header["tables"], names, buffer=buf)
+
+    def save(self, path):
+        """Write the store to a file that can be memory-mapped by
+        :meth:`open`.
+        """
+        sections = [(name, getattr(self, "_" + name))
+                    for name, _ in NUMERIC_COLUMNS]
+        sections.append(("names", self._names))
+        header = {
+                "byteorder": sys.byteorder,
+                "tables": self._tables,
+                "columns": {},
+                }
+        # Offsets depend on the header length, which depends on the
+        # offsets. Pad the header to a fixed size to break the cycle.
+        header_size = _align(len(json.dumps(header)) + 64 * len(sections) +
+                             1024)
+        offset = _align(len(MAGIC) + _HEADER_LENGTH.size + header_size)
+        for name, data in sections:
+            nbytes = len(memoryview(data).cast("B"))
+            if name == "names":
+                header["names"] = [offset, nbytes]
+            else:
+                header["columns"][name] = [offset, nbytes]
+            offset = _align(offset + nbytes)
+        encoded = json.dumps(header).encode("utf-8")
+        encoded += b" " * (header_size - len(encoded))
+
+        with io.open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LENGTH.pack(header_size))
+            f.write(encoded)
+            for name, data in sections:
+                f.write(b"\0" * (_align(f.tell()) - f.tell()))
+                f.write(memoryview(data).cast("B"))
+
+    def close(self):
+        """Unmap the store file, if the store was opened with :meth:`open`.
+        """
+        if self._buffer is None:
+            return
+        for name, _ in NUMERIC_COLUMNS:
+            getattr(self, "_" + name).release()
+        self._names.release()
+        self._buffer.close()
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, geoname_id):
+        return self.row(geoname_id) is not None
+
+    def row(self, geoname_id):
+        """Row of a geoname id, or ``None``.
+        """
+        geoname_id = int(geoname_id)
+        i = bisect.bisect_left(self._sorted_ids, geoname_id)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == geoname_id:
+            return self._id_rows[i]
+        return None
+
+    def get(self, geoname_id):
+        """Geoname dict of a geoname id, or ``None``.
+        """
+        row = self.row(geoname_id)
+        if row is None:
+            return None
+        return self.record(row)
+
+    def name(self, row):
+        offsets = self._name_offsets
+        return bytes(self._names[offsets[row]:offsets[row + 1]]).decode(
+                "utf-8")
+
+    def geoname_id(self, row):
+        return self._ids[row]
+
+    def codes(self, row):
+        """Feature class, feature code, country code, admin1 code and admin2
+        code of a row.
+        """
+        tables = self._tables
+        fcl, fcode = tables["features"][self._features[row]].split(".", 1)
+        return (fcl, fcode, tables["countries"][self._countries[row]],
+                tables["admin1s"][self._admin1s[row]],
+                tables["admin2s"][self._admin2s[row]])
+
+    def mask(self, column, accept):
+        """Filter bitmap of rows, with one byte per row, set for rows whose
+        value in `column` is accepted.
+
+        :param column: One of ``"features"`` (values like ``"P.PPLC"``),
+                       ``"countries"``, ``"admin1s"`` and ``"admin2s"``.
+        :param accept: Function taking a value and returning whether it is
+                       accepted. Called once per distinct value.
+        """
+        accepted = frozenset(i for i, value in enumerate(self._tables[column])
+                             if accept(value))
+        return bytearray(i in accepted for i in getattr(self, "_" + column))
+
+    def population(self, row):
+        return self._populations[row]
+
+    def record(self, row):
+        """Geoname dict of a row.
+        """
+        fcl, fcode = self._tables["features"][self._features[row]].split(
+                ".", 1)
+        name = self.name(row)
+        return {
+                "geonameId": self._ids[row],
+                "name": name,
+                "toponymName": name,
+                "lat": self._lats[row],
+                "lng": self._lngs[row],
+                "fcl": fcl,
+                "fcode": fcode,
+                "countryCode": self._tables["countries"][self._countries[row]],
+                "adminCode1": self._tables["admin1s"][self._admin1s[row]],
+                "population": self._populations[row],
+                }
+
+    def find_nearby_place(self, latlon, radius=None, max_rows=None,
+                          exclude_ids=None, **kwargs):
+        """Find nearby populated places (feature class P).
+
+        Without `radius`, the closest place is returned. With `radius`,
+        places within `radius` km, up to `max_rows` (default 10). Other
+        keyword arguments of :meth:`geogotchi.Geogotchi.find_nearby_place`
+        are accepted and ignored.
+
+        :param exclude_ids: Set of geoname ids to skip.
+        """
+        populated = self._populated
+        features = self._features
+        return self._find_nearby(latlon, radius, max_rows,
+                                 lambda row: features[row] in populated,
+                                 exclude_ids)
+
+    def find_nearby_toponym(self, latlon, radius=None, max_rows=None,
+                            exclude_ids=None, **kwargs):
+        """Find nearby toponyms of any feature class.
+
+        See :meth:`find_nearby_place`.
+        """
+        return self._find_nearby(latlon, radius, max_rows, None, exclude_ids)
+
+    def _find_nearby(self, latlon, radius, max_rows, accept, exclude_ids):
+        if exclude_ids:
+            ids = self._ids
+            accept_row = accept or (lambda row: True)
+            accept = lambda row: (ids[row] not in exclude_ids and
+                                  accept_row(row))
+        if max_rows is None:
+            max_rows = 1 if radius is None else 10
+        max_rows = int(max_rows)
+        if max_rows < 1 or not len(self):
+            return []
+        max_chord = 2.0 if radius is None else geo.km_to_chord(float(radius))
+        found = self._nearest(geo.to_xyz(latlon), max_rows,
+                              max_chord * max_chord, accept)
+        geonames = []
+        for d2, row in found:
+            geoname = self.record(row)
+            geoname["distance"] = round(geo.chord_to_km(math.sqrt(d2)), 5)
+            geonames.append(geoname)
+        return geonames
+
+    def _nearest(self, point, k, max_d2, accept):
+        """The `k` nearest rows within squared chord `max_d2` of `point`, as
+        a sorted list of (squared chord, row) tuples.
+        """
+        xs, ys, zs = self._xs, self._ys, self._zs
+        qx, qy, qz = point
+        # Max-heap of the best rows so far, as (-d2, -row) tuples.
+        best = []
+
+        def visit(lo, hi, depth):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            dx = qx - xs[mid]
+            dy = qy - ys[mid]
+            dz = qz - zs[mid]
+            d2 = dx * dx + dy * dy + dz * dz
+            bound = -best[0][0] if len(best) == k else max_d2
+            if d2 <= bound and (accept is None or accept(mid)):
+                if len(best) == k:
+                    heapq.heapreplace(best, (-d2, -mid))
+                else:
+                    heapq.heappush(best, (-d2, -mid))
+            axis = depth % 3
+            diff = (dx, dy, dz)[axis]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            visit(near[0], near[1], depth + 1)
+            bound = -best[0][0] if len(best) == k else max_d2
+            if diff * diff <= bound:
+                visit(far[0], far[1], depth + 1)
+
+        visit(0, len(xs), 0)
+        return sorted((-d2, -row) for d2, row in best)
+
+
+def convert_dump(source, path, feature_classes=None):
+    """Convert a GeoNames dump to a store file for :meth:`LocalGeonames.open`.
+
+    :param source: Path or text file object of the dump.
+    :param path: Path of the store file to write.
+    :param feature_classes: See :meth:`LocalGeonames.from_dump`.
+    """
+    LocalGeonames.from_dump(source, feature_classes=feature_classes).save(path)
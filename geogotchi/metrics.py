@@ -0,0 +1,161 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Metrics of API calls.
+
+A :class:`Metrics` registry passed to :class:`geogotchi.Geogotchi` records,
+per API path:
+
+* ``network``, ``parse`` and ``ranking``: histograms of seconds spent
+  waiting for responses, parsing them and ranking Wikipedia entries.
+* ``requests`` and ``bytes``: counts of HTTP requests and bytes received.
+* ``retries``: count of failed attempts that were retried.
+* ``errors.<class name>``: count of calls failing with each exception
+  class, e.g. ``errors.NoResultFound``.
+* ``<cache>.hits`` and ``<cache>.misses``: cache lookups, where ``<cache>``
+  is ``response_cache``, ``nearby_cache`` or ``hierarchy_cache``.
+
+To forward metrics elsewhere, e.g. to statsd, override
+:meth:`Metrics.increment` and :meth:`Metrics.observe`.
+"""
+
+import bisect
+import collections
+import threading
+import time
+
+# Upper bounds in seconds of the default histogram buckets.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """Counts of observed values in buckets.
+
+    :param bounds: Sorted upper bounds of the buckets. Values above the last
+                   bound go in an extra bucket.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the `q`th percentile, capped at
+        the max observed value. ``None`` if nothing was observed.
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+                "count": self.count,
+                "sum": self.sum,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p99": self.percentile(99),
+                }
+
+
+class Metrics(object):
+    """Thread-safe registry of counters and histograms, by name and API
+    path.
+
+    :param buckets: Upper bounds of histogram buckets.
+    """
+
+    # Timer used for durations.
+    clock = staticmethod(getattr(time, "perf_counter", time.time))
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+        self._histograms = {}
+
+    def increment(self, name, path, value=1):
+        with self._lock:
+            self._counters[name, path] += value
+
+    def observe(self, name, path, value):
+        with self._lock:
+            histogram = self._histograms.get((name, path))
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self._histograms[name, path] = histogram
+            histogram.observe(value)
+
+    def counter(self, name, path):
+        with self._lock:
+            return self._counters.get((name, path), 0)
+
+    def histogram(self, name, path):
+        """The :class:`Histogram` of `name` for `path`, or ``None``.
+        """
+        with self._lock:
+            return self._histograms.get((name, path))
+
+    def hit_ratio(self, cache, path):
+        """Ratio of lookups in `cache` for `path` that were hits, or
+        ``None`` if there were no lookups.
+        """
+        hits = self.counter(cache + ".hits", path)
+        lookups = hits + self.counter(cache + ".misses", path)
+        if not lookups:
+            return None
+        return hits / float(lookups)
+
+    def snapshot(self):
+        """All metrics as a dict of ``{name: {path: value}}``, with
+        histograms as dicts.
+        """
+        snapshot = collections.defaultdict(dict)
+        with self._lock:
+            for (name, path), value in self._counters.items():
+                snapshot[name][path] = value
+            for (name, path), histogram in self._histograms.items():
+                snapshot[name][path] = histogram.to_dict()
+        return dict(snapshot)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
@@ -0,0 +1,130 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Ranking of Wikipedia entries by weighted rank and distance.
+
+An entry scores ``rank_weight * rank + distance_weight * (1 - distance)``,
+with ranks and distances normalized to unit length over the result set.
+Entries are ordered by descending score, ties broken by descending position
+in the result set. Uses NumPy for large result sets when it is installed.
+"""
+
+import heapq
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Result sets smaller than this are ranked in pure Python, where NumPy's
+# per call overhead outweighs its gains.
+NUMPY_THRESHOLD = 64
+
+
+def _norm(V):
+    L = math.sqrt(sum([x**2 for x in V]))
+    if L == 0:
+        max_val = float(max(map(abs, V)))
+        if max_val == 0.0:
+            return [0.0 for x in V]
+        return [x/max_val for x in V]
+    return [x/L for x in V]
+
+
+def _use_numpy(nearby):
+    return numpy is not None and len(nearby) >= NUMPY_THRESHOLD
+
+
+def _normalized(nearby):
+    ranks = _norm([entry["rank"] for entry in nearby])
+    dists = _norm([entry["distance"] for entry in nearby])
+    return ranks, dists
+
+
+def scores(nearby, weights):
+    """Scores of a result set for many weight pairs at once.
+
+    :param nearby: Wikipedia entries, as returned by the API.
+    :param weights: List of (rank_weight, distance_weight) tuples.
+    :returns: One list of scores per weight pair, or a 2-d array if NumPy
+              is used.
+    """
+    if not nearby:
+        return [[] for _ in weights]
+    ranks, dists = _normalized(nearby)
+    if _use_numpy(nearby):
+        ranks = numpy.array(ranks, dtype=float)
+        dists = numpy.array(dists, dtype=float)
+        weights = numpy.array(weights, dtype=float).reshape(-1, 2)
+        return (weights[:, 0:1] * ranks +
+                weights[:, 1:2] * (1.0 - dists))
+    return [[rank_weight * r + distance_weight * (1.0 - d)
+             for r, d in zip(ranks, dists)]
+            for rank_weight, distance_weight in weights]
+
+
+def _order(row, top_k):
+    # Positions of a row of scores, best first.
+    n = len(row)
+    if top_k is not None:
+        top_k = max(0, min(int(top_k), n))
+    if numpy is not None and isinstance(row, numpy.ndarray):
+        positions = numpy.arange(n)
+        if top_k is not None and top_k < n:
+            if top_k == 0:
+                return []
+            # Everything scoring at least the k-th best score, which may
+            # include ties past k, then an exact sort of those.
+            threshold = numpy.partition(row, n - top_k)[n - top_k]
+            positions = numpy.flatnonzero(row >= threshold)
+            row = row[positions]
+        # lexsort sorts by its last key first.
+        order = positions[numpy.lexsort((positions, row))[::-1]]
+        return order[:top_k].tolist()
+    key = lambda i: (row[i], i)
+    if top_k is None:
+        return sorted(range(n), key=key, reverse=True)
+    return heapq.nlargest(top_k, range(n), key=key)
+
+
+def rank(nearby, rank_weight=1.0, distance_weight=1.0, top_k=None):
+    """Sort Wikipedia entries by weighted rank and distance, descending.
+
+    :param nearby: Wikipedia entries, as returned by the API.
+    :param top_k: Only return the `top_k` best entries, without sorting the
+                  whole result set.
+    """
+    return rank_many(nearby, [(rank_weight, distance_weight)], top_k)[0]
+
+
+def rank_many(nearby, weights, top_k=None):
+    """Rank a result set for many weight pairs at once.
+
+    Normalization is done once for the result set, and with NumPy all
+    scores are computed in one go.
+
+    :param nearby: Wikipedia entries, as returned by the API.
+    :param weights: List of (rank_weight, distance_weight) tuples.
+    :param top_k: See :func:`rank`.
+    :returns: One list of entries per weight pair.
+    """
+    return [[nearby[i] for i in _order(row, top_k)]
+            for row in scores(nearby, weights)]
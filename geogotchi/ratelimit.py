@@ -0,0 +1,131 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+
+from geogotchi import errors
+
+HOUR = 3600.0
+DAY = 24 * HOUR
+
+# Credit limits of free geonames.org accounts.
+DEFAULT_HOURLY_CREDITS = 1000
+DEFAULT_DAILY_CREDITS = 10000
+
+
+class TokenBucket(object):
+    """Token bucket holding up to `capacity` credits, refilled at a steady
+    rate of `capacity` credits per `period` seconds.
+
+    Not thread-safe on its own, :class:`RateLimiter` serializes access.
+    """
+
+    def __init__(self, capacity, period, clock=time.time):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = max(0.0, now - self._updated)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def wait_time(self, cost):
+        """Seconds until `cost` credits are available.
+        """
+        self._refill()
+        missing = cost - self._tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate
+
+    def take(self, cost):
+        self._refill()
+        self._tokens -= cost
+
+
+class RateLimiter(object):
+    """Client side rate limiter for geonames.org credits.
+
+    Keeps one token bucket per budget, so bursts are allowed as long as the
+    hourly and daily budgets hold. Safe to share between threads and
+    clients using the same account.
+
+    :param hourly: Credits per hour, or ``None`` for no hourly budget.
+    :param daily: Credits per day, or ``None`` for no daily budget.
+    :param costs: Dict mapping API paths (e.g. ``"searchJSON"``) to their
+                  credit cost. Paths not in the dict cost `default_cost`.
+    :param default_cost: Credit cost of paths not in `costs`.
+    :param block: Wait for credits to become available. If false,
+                  :class:`geogotchi.errors.RateLimitExceeded` is raised
+                  immediately instead.
+    """
+
+    def __init__(self, hourly=DEFAULT_HOURLY_CREDITS,
+                 daily=DEFAULT_DAILY_CREDITS, costs=None, default_cost=1,
+                 block=True, clock=time.time, sleep=time.sleep):
+        self._buckets = []
+        if hourly is not None:
+            self._buckets.append(("hourly", TokenBucket(hourly, HOUR, clock)))
+        if daily is not None:
+            self._buckets.append(("daily", TokenBucket(daily, DAY, clock)))
+        self.costs = dict(costs or {})
+        self.default_cost = default_cost
+        self.block = block
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    def cost(self, path):
+        return self.costs.get(path, self.default_cost)
+
+    def acquire(self, path, block=None):
+        """Take the credits needed for a call to `path`.
+
+        :param path: API path.
+        :param block: Overrides the limiter's `block` setting.
+        """
+        if block is None:
+            block = self.block
+        cost = self.cost(path)
+        for name, bucket in self._buckets:
+            if cost > bucket.capacity:
+                raise errors.RateLimitExceeded(
+                        "%s costs %s credits, %s budget is %s"
+                        % (path, cost, name, bucket.capacity))
+        while True:
+            with self._lock:
+                wait, name = 0.0, None
+                for bucket_name, bucket in self._buckets:
+                    bucket_wait = bucket.wait_time(cost)
+                    if bucket_wait > wait:
+                        wait, name = bucket_wait, bucket_name
+                if wait <= 0:
+                    for _, bucket in self._buckets:
+                        bucket.take(cost)
+                    return
+            if not block:
+                raise errors.RateLimitExceeded(
+                        "%s credit budget exhausted, retry in %.1f s"
+                        % (name, wait))
+            self._sleep(wait)
@@ -0,0 +1,136 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+
+from collections.abc import MutableMapping
+
+# API keys stored in slots, and their slot names. Other keys go in a dict.
+FIELDS = [
+        ("geonameId", "geoname_id"),
+        ("name", "name"),
+        ("toponymName", "toponym_name"),
+        ("lat", "lat"),
+        ("lng", "lng"),
+        ("distance", "distance"),
+        ("population", "population"),
+        ("countryCode", "country_code"),
+        ("fcl", "fcl"),
+        ("fcode", "fcode"),
+        ("adminCode1", "admin_code1"),
+        ]
+
+_SLOTS = dict(FIELDS)
+
+# Low cardinality string fields. Their values are interned, so records
+# share one string object per distinct value.
+_INTERNED = frozenset(["countryCode", "fcl", "fcode", "adminCode1"])
+
+_intern = sys.intern
+
+
+class Geoname(MutableMapping):
+    """Compact geoname record.
+
+    Common fields are kept in slots, and available as attributes (e.g.
+    ``geoname.geoname_id``). Any other fields are kept in a dict that is
+    only created when needed. Values of code fields like ``countryCode``
+    are interned. Supports the same mapping access as the dicts returned by
+    default, with the API's key names::
+
+        >>> geoname["geonameId"] == geoname.geoname_id
+        True
+    """
+
+    __slots__ = [slot for _, slot in FIELDS] + ["_extra"]
+
+    def __init__(self, fields=None):
+        self._extra = None
+        if fields:
+            for key, value in fields.items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        slot = _SLOTS.get(key)
+        if slot is not None:
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        slot = _SLOTS.get(key)
+        if slot is not None:
+            if key in _INTERNED and type(value) is str:
+                value = _intern(value)
+            setattr(self, slot, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        slot = _SLOTS.get(key)
+        if slot is not None:
+            try:
+                delattr(self, slot)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key, slot in FIELDS:
+            if hasattr(self, slot):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        n = sum(1 for _, slot in FIELDS if hasattr(self, slot))
+        if self._extra is not None:
+            n += len(self._extra)
+        return n
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self._extra = None
+        for key, value in state.items():
+            self[key] = value
+
+    def __repr__(self):
+        return "Geoname(%r)" % dict(self)
+
+    def to_dict(self):
+        return dict(self)
+
+
+def to_records(geonames):
+    """Convert a list of geoname dicts to :class:`Geoname` records.
+    """
+    return [Geoname(geoname) for geoname in geonames]
@@ -0,0 +1,414 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Incremental refresh of offline data from the GeoNames daily diffs.
+
+The daily ``modifications-*.txt``, ``deletes-*.txt``,
+``alternateNamesModifications-*.txt`` and ``alternateNamesDeletes-*.txt``
+files are applied on top of a base dataset, which is left as is. Changed
+and new geonames go in small overlay indexes, and changed or deleted base
+geonames are hidden by tombstones. Each refresh builds a new
+:class:`Dataset` and swaps it into a :class:`LiveDataset` in one step, so
+readers see either the old or the new version, never a mix::
+
+    >>> live = LiveDataset(Dataset(store, hierarchy, search, "2024-01-01"))
+    >>> updater = Updater(live)
+    >>> updater.apply_files("/data/geonames", "2024-01-02")
+    >>> live.find_nearby_place(lkpg)
+
+Overlays grow with every refresh, so rebuild the base from a full dump now
+and then, e.g. monthly.
+"""
+
+import collections
+import heapq
+import os
+import threading
+
+from geogotchi.base import _geoname_id
+from geogotchi.hierarchy import _read_tsv
+from geogotchi.local import _ALTERNATENAMES
+from geogotchi.local import _ASCIINAME
+from geogotchi.local import _Builder
+from geogotchi.local import LocalGeonames
+from geogotchi.search import _as_list
+from geogotchi.search import DEFAULT_MAX_ROWS
+from geogotchi.search import LocalSearch
+from geogotchi.search import NON_NAME_LANGUAGES
+from geogotchi import errors
+
+Dataset = collections.namedtuple("Dataset",
+                                 ["store", "hierarchy", "search", "version"])
+
+
+def _build_store(rows):
+    builder = _Builder()
+    for fields in rows:
+        builder.add(fields)
+    return LocalGeonames(*builder.build())
+
+
+def _dump_fields(store, row):
+    # Dump row of a store row, for the columns a store keeps.
+    fcl, fcode, country, admin1, admin2 = store.codes(row)
+    record = store.record(row)
+    fields = [""] * 19
+    fields[0] = str(record["geonameId"])
+    fields[1] = fields[_ASCIINAME] = record["name"]
+    fields[4] = repr(record["lat"])
+    fields[5] = repr(record["lng"])
+    fields[6], fields[7], fields[8] = fcl, fcode, country
+    fields[10], fields[11] = admin1, admin2
+    fields[14] = str(record["population"])
+    return fields
+
+
+class OverlayGeonames(object):
+    """A :class:`geogotchi.local.LocalGeonames` base with an overlay of
+    changed and new geonames.
+
+    :param base: The base store.
+    :param overlay: Store of changed and new geonames.
+    :param hidden: Ids of base geonames that are changed or deleted.
+    """
+
+    def __init__(self, base, overlay, hidden):
+        self.base = base
+        self.overlay = overlay
+        self.hidden = frozenset(hidden)
+        self._len = (len(base) + len(overlay) -
+                     sum(1 for geoname_id in self.hidden
+                         if geoname_id in base))
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, geoname_id):
+        return self.locate(geoname_id) is not None
+
+    def locate(self, geoname_id):
+        """Store and row of a geoname id, or ``None``.
+        """
+        geoname_id = int(geoname_id)
+        row = self.overlay.row(geoname_id)
+        if row is not None:
+            return self.overlay, row
+        if geoname_id in self.hidden:
+            return None
+        row = self.base.row(geoname_id)
+        if row is not None:
+            return self.base, row
+        return None
+
+    def get(self, geoname_id):
+        """Geoname dict of a geoname id, or ``None``.
+        """
+        located = self.locate(geoname_id)
+        if located is None:
+            return None
+        store, row = located
+        return store.record(row)
+
+    def find_nearby_place(self, latlon, radius=None, max_rows=None,
+                          **kwargs):
+        """See :meth:`geogotchi.local.LocalGeonames.find_nearby_place`.
+        """
+        return self._find_nearby("find_nearby_place", latlon, radius,
+                                 max_rows)
+
+    def find_nearby_toponym(self, latlon, radius=None, max_rows=None,
+                            **kwargs):
+        """See :meth:`geogotchi.local.LocalGeonames.find_nearby_toponym`.
+        """
+        return self._find_nearby("find_nearby_toponym", latlon, radius,
+                                 max_rows)
+
+    def _find_nearby(self, method, latlon, radius, max_rows):
+        if max_rows is None:
+            max_rows = 1 if radius is None else 10
+        base = getattr(self.base, method)(latlon, radius, max_rows,
+                                          exclude_ids=self.hidden)
+        overlay = getattr(self.overlay, method)(latlon, radius, max_rows)
+        return heapq.nsmallest(int(max_rows), base + overlay,
+                               key=lambda geoname: geoname["distance"])
+
+
+class OverlayHierarchy(object):
+    """Hierarchies of an :class:`OverlayGeonames` store.
+
+    Hierarchies untouched by the overlay come straight from the base
+    hierarchy. Other geonames get their parents from the base hierarchy,
+    if they are still there, or else from their admin codes.
+
+    :param base: A :class:`geogotchi.hierarchy.LocalHierarchy` of the base
+                 store.
+    :param store: An :class:`OverlayGeonames`.
+    """
+
+    # Guards against cycles in corrupt data.
+    max_depth = 64
+
+    def __init__(self, base, store):
+        self.base = base
+        self.store = store
+
+    def get_hierarchy(self, geoname):
+        """See :meth:`geogotchi.Geogotchi.get_hierarchy`.
+        """
+        geoname_id = _geoname_id(geoname)
+        located = self.store.locate(geoname_id)
+        if located is None:
+            raise errors.RecordDoesNotExist(
+                    "no geoname with id %s" % geoname_id)
+        store, row = located
+        hidden = self.store.hidden
+        if store is self.store.base:
+            chain = self.base.chain(row)
+            if not any(store.geoname_id(r) in hidden for r in chain):
+                return [store.record(r) for r in chain]
+
+        hierarchy = []
+        seen = set()
+        while located is not None and len(hierarchy) < self.max_depth:
+            store, row = located
+            seen.add(store.geoname_id(row))
+            hierarchy.append(store.record(row))
+            located = self._parent(store, row, seen)
+        hierarchy.reverse()
+        return hierarchy
+
+    def get_hierarchies(self, geonames):
+        """Hierarchies of many geonames, in the same order.
+        """
+        return [self.get_hierarchy(geoname) for geoname in geonames]
+
+    def _parent(self, store, row, seen):
+        candidates = []
+        if store is self.store.base:
+            parent_row = self.base.parent(row)
+            if parent_row is not None:
+                candidates.append(store.geoname_id(parent_row))
+        candidates.extend(self.base.parent_ids(store.geoname_id(row),
+                                               store.codes(row)))
+        for parent_id in candidates:
+            if parent_id not in seen:
+                located = self.store.locate(parent_id)
+                if located is not None:
+                    return located
+        return None
+
+
+class OverlaySearch(object):
+    """Name search of a base index and an overlay index, emulating
+    :meth:`geogotchi.Geogotchi.search`.
+
+    :param base: A :class:`geogotchi.search.LocalSearch` of the base store.
+    :param overlay: A :class:`geogotchi.search.LocalSearch` of changed and
+                    new geonames.
+    :param hidden: Ids of base geonames that are changed or deleted.
+    """
+
+    def __init__(self, base, overlay, hidden):
+        self.base = base
+        self.overlay = overlay
+        self.hidden = frozenset(hidden)
+
+    def search(self, **kwargs):
+        """See :meth:`geogotchi.search.LocalSearch.search`.
+        """
+        start_row = int(kwargs.pop("start_row", None) or 0)
+        max_rows = kwargs.pop("max_rows", None)
+        max_rows = DEFAULT_MAX_ROWS if max_rows is None else int(max_rows)
+        wanted = start_row + max_rows
+        base = self.base.search(max_rows=wanted, exclude_ids=self.hidden,
+                                **kwargs)
+        overlay = self.overlay.search(max_rows=wanted, **kwargs)
+        found = dict((geoname["geonameId"], geoname) for geoname in base)
+        found.update((geoname["geonameId"], geoname) for geoname in overlay)
+        bias = kwargs.get("country_bias")
+        if bias is not None:
+            bias = frozenset(_as_list(bias))
+            key = lambda g: (g["countryCode"] not in bias, -g["population"],
+                             g["geonameId"])
+        else:
+            key = lambda g: (-g["population"], g["geonameId"])
+        return heapq.nsmallest(wanted, found.values(), key=key)[start_row:]
+
+
+class LiveDataset(object):
+    """The current version of a :class:`Dataset`, swapped atomically by
+    :meth:`swap`.
+
+    Has the lookup methods of :class:`geogotchi.local.LocalGeonames`,
+    :class:`geogotchi.hierarchy.LocalHierarchy` and
+    :class:`geogotchi.search.LocalSearch`, so it can be passed as each of
+    them to :class:`geogotchi.resolver.TieredResolver`. Each call uses one
+    version throughout.
+    """
+
+    def __init__(self, dataset):
+        self.current = dataset
+
+    def swap(self, dataset):
+        """Make `dataset` the current version. Returns the previous one.
+        """
+        previous = self.current
+        self.current = dataset
+        return previous
+
+    def __len__(self):
+        return len(self.current.store)
+
+    def __contains__(self, geoname_id):
+        return geoname_id in self.current.store
+
+    def get(self, geoname_id):
+        return self.current.store.get(geoname_id)
+
+    def find_nearby_place(self, latlon, **kwargs):
+        return self.current.store.find_nearby_place(latlon, **kwargs)
+
+    def find_nearby_toponym(self, latlon, **kwargs):
+        return self.current.store.find_nearby_toponym(latlon, **kwargs)
+
+    def get_hierarchy(self, geoname):
+        return self.current.hierarchy.get_hierarchy(geoname)
+
+    def get_hierarchies(self, geonames):
+        return self.current.hierarchy.get_hierarchies(geonames)
+
+    def search(self, **kwargs):
+        return self.current.search.search(**kwargs)
+
+
+class Updater(object):
+    """Applies GeoNames daily diffs to a :class:`LiveDataset`.
+
+    Changes accumulate on top of the dataset current when the updater is
+    created, which must be a base dataset rather than one built by an
+    updater, so keep one updater per base for all its refreshes. Each
+    :meth:`apply` rebuilds the overlays from all changes so far, which
+    takes time in proportion to them rather than to the base.
+
+    Alternate name deletions only apply to names added by diffs. Names in
+    the base index stay until the base is rebuilt.
+
+    :param live: A :class:`LiveDataset`.
+    :param country_info: Dict from
+                         :func:`geogotchi.hierarchy.read_country_info`,
+                         required for `continent_code` searches.
+    """
+
+    def __init__(self, live, country_info=None):
+        if isinstance(live.current.store, OverlayGeonames):
+            raise errors.GeogotchiError(
+                    "dataset %s is already refreshed, use its updater" %
+                    live.current.version)
+        self._live = live
+        self._base = live.current
+        self._country_info = country_info
+        self._rows = {}
+        self._deleted = set()
+        self._alternate_names = {}
+        self._lock = threading.Lock()
+
+    def apply(self, modifications=None, deletes=None,
+              alternate_names=None, alternate_name_deletes=None,
+              version=None):
+        """Apply diff files and swap in the resulting dataset.
+
+        Each argument is a path or text file object, or ``None``.
+
+        :returns: The new :class:`Dataset`.
+        """
+        with self._lock:
+            if modifications is not None:
+                for fields in _read_tsv(modifications):
+                    if len(fields) >= 19:
+                        geoname_id = int(fields[0])
+                        self._rows[geoname_id] = fields
+                        self._deleted.discard(geoname_id)
+            if deletes is not None:
+                for fields in _read_tsv(deletes):
+                    geoname_id = int(fields[0])
+                    self._rows.pop(geoname_id, None)
+                    self._deleted.add(geoname_id)
+            if alternate_names is not None:
+                for fields in _read_tsv(alternate_names):
+                    if len(fields) >= 4 and fields[2] not in NON_NAME_LANGUAGES:
+                        self._alternate_names[int(fields[0])] = (
+                                int(fields[1]), fields[3])
+            if alternate_name_deletes is not None:
+                for fields in _read_tsv(alternate_name_deletes):
+                    self._alternate_names.pop(int(fields[0]), None)
+            dataset = self._build(version)
+            self._live.swap(dataset)
+            return dataset
+
+    def apply_files(self, directory, date):
+        """Apply the diff files of `date` (``YYYY-MM-DD``) found in
+        `directory`.
+        """
+        paths = []
+        for name in ["modifications", "deletes",
+                     "alternateNamesModifications", "alternateNamesDeletes"]:
+            path = os.path.join(directory, "%s-%s.txt" % (name, date))
+            paths.append(path if os.path.exists(path) else None)
+        return self.apply(*paths, version=date)
+
+    def _build(self, version):
+        base = self._base
+        hidden = set(self._rows)
+        hidden.update(self._deleted)
+        overlay = _build_store(self._rows.values())
+        store = OverlayGeonames(base.store, overlay, hidden)
+
+        hierarchy = None
+        if base.hierarchy is not None:
+            hierarchy = OverlayHierarchy(base.hierarchy, store)
+
+        search = None
+        if base.search is not None:
+            names = []
+            for fields in self._rows.values():
+                geoname_id = int(fields[0])
+                names.append((geoname_id, fields[_ASCIINAME]))
+                names.extend((geoname_id, name)
+                             for name in fields[_ALTERNATENAMES].split(",")
+                             if name)
+            # Base geonames with new alternate names are copied to the
+            # search overlay, and found in both indexes.
+            rows = list(self._rows.values())
+            copied = set()
+            for geoname_id, name in self._alternate_names.values():
+                names.append((geoname_id, name))
+                if (geoname_id not in self._rows and
+                        geoname_id not in self._deleted and
+                        geoname_id not in copied):
+                    row = base.store.row(geoname_id)
+                    if row is not None:
+                        rows.append(_dump_fields(base.store, row))
+                        copied.add(geoname_id)
+            names_store = overlay if not copied else _build_store(rows)
+            search = OverlaySearch(
+                    base.search,
+                    LocalSearch(names_store, names, self._country_info),
+                    hidden)
+        return Dataset(store, hierarchy, search, version)
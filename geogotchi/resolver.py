@@ -0,0 +1,220 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Lookups answered from local data when possible, and from the web
+services otherwise.
+"""
+
+import collections
+import threading
+
+from geogotchi.base import map_batch
+from geogotchi.hierarchy import EARTH_ID
+from geogotchi import errors
+from geogotchi import records
+from geogotchi import track
+
+# Tiers serving calls.
+LOCAL = "local"
+HTTP = "http"
+
+# Default km beyond which local nearby results are not trusted.
+DEFAULT_MAX_DISTANCE = 20.0
+
+
+class TieredResolver(object):
+    """Drop-in replacement for :class:`geogotchi.Geogotchi` that tries local
+    backends first.
+
+    A call falls through to the web services when no local backend is
+    configured for it, the local data is stale, the local backend finds
+    nothing or fails, or, with `fill_rows`, it finds fewer rows than an
+    explicit `max_rows`. Local hierarchies not reaching up to the Earth,
+    as from stores without continents, fall through too. Nearby lookups without a `radius` always find the closest
+    local row, however far, so rows farther away than `max_distance` are
+    dropped first. Caches configured on `client` apply to calls it serves,
+    and local results are converted to records if `client` returns
+    records.
+
+    The tier serving each call is counted in :attr:`served`, keyed by
+    (method name, tier), and in `metrics` as ``tiers.local`` and
+    ``tiers.http`` by method name.
+
+    :param client: A :class:`geogotchi.Geogotchi`.
+    :param local: A :class:`geogotchi.local.LocalGeonames` for
+                  :meth:`find_nearby_place` and :meth:`find_nearby_toponym`.
+    :param hierarchy: A :class:`geogotchi.hierarchy.LocalHierarchy` for
+                      :meth:`get_hierarchy`.
+    :param search: A :class:`geogotchi.search.LocalSearch` for
+                   :meth:`search`.
+    :param fill_rows: Fall through when local results have fewer rows than
+                      an explicit `max_rows`.
+    :param is_stale: Function returning whether local data is stale, in
+                     which case every call falls through.
+    :param max_distance: Max distance in km of local nearby results for
+                         calls without a `radius`, beyond which the point
+                         is taken to be outside the local data.
+    :param metrics: A :class:`geogotchi.metrics.Metrics` registry.
+    """
+
+    def __init__(self, client, local=None, hierarchy=None, search=None,
+                 fill_rows=True, is_stale=None, metrics=None,
+                 max_distance=DEFAULT_MAX_DISTANCE):
+        self._client = client
+        self._local = local
+        self._hierarchy = hierarchy
+        self._search = search
+        self._fill_rows = fill_rows
+        self._is_stale = is_stale
+        self._metrics = metrics
+        self._max_distance = max_distance
+        self._lock = threading.Lock()
+        self.served = collections.Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the client.
+        """
+        self._client.close()
+
+    def find_nearby_place(self, latlon, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_place`.
+        """
+        return self._find_nearby("find_nearby_place", latlon, kwargs)
+
+    def find_nearby_toponym(self, latlon, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_toponym`.
+        """
+        return self._find_nearby("find_nearby_toponym", latlon, kwargs)
+
+    def find_nearby_wikipedia(self, latlon, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_wikipedia`. Always
+        served by the web services.
+        """
+        self._served("find_nearby_wikipedia", HTTP)
+        return self._client.find_nearby_wikipedia(latlon, **kwargs)
+
+    def find_nearby_place_many(self, latlons, max_workers=None, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_place_many`.
+        """
+        return self._many(self.find_nearby_place, latlons, max_workers,
+                          kwargs)
+
+    def find_nearby_toponym_many(self, latlons, max_workers=None, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_toponym_many`.
+        """
+        return self._many(self.find_nearby_toponym, latlons, max_workers,
+                          kwargs)
+
+    def find_nearby_wikipedia_many(self, latlons, max_workers=None,
+                                   **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_wikipedia_many`.
+        """
+        return self._many(self.find_nearby_wikipedia, latlons, max_workers,
+                          kwargs)
+
+    def find_nearby_place_track(self, latlons, timestamps=None,
+                                threshold=track.DEFAULT_THRESHOLD,
+                                max_age=None, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.find_nearby_place_track`.
+        """
+        lookup = lambda latlon: self.find_nearby_place(latlon, **kwargs)
+        return track.resolve_track(lookup, latlons, timestamps, threshold,
+                                   max_age)
+
+    def get_hierarchy(self, geoname):
+        """See :meth:`geogotchi.Geogotchi.get_hierarchy`.
+        """
+        if self._use(self._hierarchy):
+            try:
+                hierarchy = self._hierarchy.get_hierarchy(geoname)
+            except errors.RecordDoesNotExist:
+                pass
+            else:
+                if hierarchy and hierarchy[0]["geonameId"] == EARTH_ID:
+                    self._served("get_hierarchy", LOCAL)
+                    return self._local_result(hierarchy)
+        self._served("get_hierarchy", HTTP)
+        return self._client.get_hierarchy(geoname)
+
+    def search(self, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.search`.
+        """
+        if self._use(self._search):
+            try:
+                geonames = self._search.search(**kwargs)
+            except errors.GeogotchiError:
+                # E.g. filters the local index cannot apply.
+                geonames = None
+            if self._enough(geonames, kwargs.get("max_rows")):
+                self._served("search", LOCAL)
+                return self._local_result(geonames)
+        self._served("search", HTTP)
+        return self._client.search(**kwargs)
+
+    def iter_search(self, **kwargs):
+        """See :meth:`geogotchi.Geogotchi.iter_search`. Always served by the
+        web services.
+        """
+        self._served("iter_search", HTTP)
+        return self._client.iter_search(**kwargs)
+
+    def _find_nearby(self, method, latlon, kwargs):
+        if self._use(self._local):
+            geonames = getattr(self._local, method)(latlon, **kwargs)
+            if kwargs.get("radius") is None:
+                geonames = [geoname for geoname in geonames
+                            if geoname["distance"] <= self._max_distance]
+            if self._enough(geonames, kwargs.get("max_rows")):
+                self._served(method, LOCAL)
+                return self._local_result(geonames)
+        self._served(method, HTTP)
+        return getattr(self._client, method)(latlon, **kwargs)
+
+    def _many(self, func, latlons, max_workers, kwargs):
+        if max_workers is None:
+            max_workers = self._client.pool_maxsize
+        return map_batch(func, latlons, max_workers, kwargs)
+
+    def _local_result(self, geonames):
+        if self._client.returns_records:
+            return records.to_records(geonames)
+        return geonames
+
+    def _use(self, backend):
+        return (backend is not None and
+                (self._is_stale is None or not self._is_stale()))
+
+    def _enough(self, geonames, max_rows):
+        if not geonames:
+            return False
+        return (not self._fill_rows or max_rows is None or
+                len(geonames) >= int(max_rows))
+
+    def _served(self, method, tier):
+        with self._lock:
+            self.served[method, tier] += 1
+        if self._metrics is not None:
+            self._metrics.increment("tiers." + tier, method)
@@ -0,0 +1,117 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import random
+import time
+
+import requests
+
+from geogotchi import errors
+
+# Transient errors that are worth another try.
+RETRYABLE_ERRORS = (errors.DatabaseTimeout,
+                    errors.ServerOverloadedException,
+                    requests.ConnectionError,
+                    requests.Timeout)
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RetryPolicy(object):
+    """Retries API calls failing with transient errors.
+
+    Waits between attempts grow exponentially, ``backoff * multiplier **
+    (attempt - 1)`` capped at `max_backoff`. With `jitter`, the wait is
+    drawn uniformly between zero and that value, so clients failing at the
+    same time do not retry in lockstep.
+
+    :param max_attempts: Max number of attempts, including the first one.
+    :param backoff: Wait in seconds after the first failed attempt.
+    :param multiplier: Growth factor of the wait between attempts.
+    :param max_backoff: Max wait in seconds between attempts.
+    :param jitter: Randomize waits.
+    :param deadline: Max total seconds spent on a call, including waits, or
+                     ``None``. Also bounds the timeout of each request.
+    :param retry_on: Exception classes to retry.
+    :param retry_status_codes: HTTP status codes of
+                               :class:`geogotchi.errors.HTTPError` to retry.
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.5, multiplier=2.0,
+                 max_backoff=30.0, jitter=True, deadline=None,
+                 retry_on=RETRYABLE_ERRORS,
+                 retry_status_codes=RETRYABLE_STATUS_CODES,
+                 clock=time.time, sleep=time.sleep, random=random.random):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_on = tuple(retry_on)
+        self.retry_status_codes = frozenset(retry_status_codes)
+        self._clock = clock
+        self._sleep = sleep
+        self._random = random
+
+    def is_retryable(self, exc):
+        if isinstance(exc, errors.HTTPError):
+            return exc.status_code in self.retry_status_codes
+        return isinstance(exc, self.retry_on)
+
+    def delay(self, attempt):
+        """Seconds to wait after failed attempt number `attempt`.
+        """
+        delay = min(self.max_backoff,
+                    self.backoff * self.multiplier ** (attempt - 1))
+        if self.jitter:
+            delay *= self._random()
+        return delay
+
+    def call(self, func, timeout=None, on_retry=None):
+        """Call `func` until it succeeds or fails with a non-retryable error.
+
+        `func` is called with the request timeout to use, `timeout` shortened
+        to what is left of the deadline. `on_retry`, if given, is called with
+        the exception of each attempt that is retried.
+        """
+        start = self._clock()
+        attempt = 0
+        while True:
+            attempt += 1
+            attempt_timeout = timeout
+            if self.deadline is not None:
+                remaining = self.deadline - (self._clock() - start)
+                if attempt_timeout is None or remaining < attempt_timeout:
+                    attempt_timeout = remaining
+            try:
+                return func(attempt_timeout)
+            except Exception as e:
+                if attempt >= self.max_attempts or not self.is_retryable(e):
+                    raise
+                delay = self.delay(attempt)
+                if (self.deadline is not None and
+                        self._clock() - start + delay >= self.deadline):
+                    raise
+                if on_retry is not None:
+                    on_retry(e)
+                self._sleep(delay)
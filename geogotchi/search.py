@@ -0,0 +1,340 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Offline name search over a GeoNames dump.
+"""
+
+import array
+import collections
+import heapq
+import itertools
+import re
+import unicodedata
+
+from geogotchi.cache import LRUCache
+from geogotchi.hierarchy import read_country_info
+from geogotchi.local import _ALTERNATENAMES
+from geogotchi.local import _ASCIINAME
+from geogotchi.local import _ID
+from geogotchi.local import _open_text
+from geogotchi import errors
+
+# Default number of results, as for searchJSON.
+DEFAULT_MAX_ROWS = 100
+
+# alternateNames.txt "languages" that are not names.
+NON_NAME_LANGUAGES = frozenset(["link", "post", "iata", "icao", "faac",
+                                "abbr", "wkdt", "unlc", "tcid", "fr_1793"])
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(text):
+    """Lower case `text` and strip its accents.
+    """
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+    text = unicodedata.normalize("NFKD", text)
+    return u"".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text):
+    return _TOKEN.findall(normalize(text))
+
+
+def _trigrams(token):
+    padded = u"  %s " % token
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def read_alternate_names(source, languages=None):
+    """Read ``alternateNames.txt``. Yields (geoname id, name) tuples.
+
+    :param languages: Only read names in these ISO languages, e.g.
+                      ``["", "en", "sv"]``. Defaults to all names.
+    """
+    with _open_text(source) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 4 or fields[2] in NON_NAME_LANGUAGES:
+                continue
+            if languages is not None and fields[2] not in languages:
+                continue
+            yield int(fields[1]), fields[3]
+
+
+def read_dump_alternate_names(source):
+    """Read the ASCII names and alternate names columns of a GeoNames dump.
+    Yields (geoname id, name) tuples.
+    """
+    with _open_text(source) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 19 or line.startswith("#"):
+                continue
+            geoname_id = int(fields[_ID])
+            yield geoname_id, fields[_ASCIINAME]
+            for name in fields[_ALTERNATENAMES].split(","):
+                if name:
+                    yield geoname_id, name
+
+
+def _union(term):
+    # Ranks in any posting list of a term, in order.
+    if len(term) == 1:
+        return iter(term[0])
+    return (rank for rank, _ in itertools.groupby(heapq.merge(*term)))
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return list(value)
+    return [value]
+
+
+class LocalSearch(object):
+    """Name search without API calls, emulating
+    :meth:`geogotchi.Geogotchi.search`.
+
+    Names and alternate names of a :class:`geogotchi.local.LocalGeonames`
+    store are indexed by word, ignoring case and accents. Fuzzy searches
+    match words by trigram similarity. Results are ordered by descending
+    population. Rows are ranked in that order when the index is built, and
+    posting lists are kept in rank order, so a query stops reading them
+    once it has found the rows it returns.
+
+    Filters are one byte per row bitmaps, built on first use and kept for
+    later queries with the same filter values.
+
+    :param store: A :class:`geogotchi.local.LocalGeonames`.
+    :param alternate_names: Iterable of (geoname id, name) tuples, e.g. from
+                            :func:`read_alternate_names`.
+    :param country_info: Dict from
+                         :func:`geogotchi.hierarchy.read_country_info`,
+                         required for `continent_code` filters.
+    :param max_bitmaps: Max number of filter bitmaps kept.
+    """
+
+    def __init__(self, store, alternate_names=(), country_info=None,
+                 max_bitmaps=64):
+        self._store = store
+        # Rows by rank, and ranks by row.
+        order = sorted(range(len(store)),
+                       key=lambda row: (-store.population(row),
+                                        store.geoname_id(row)))
+        self._rows = array.array("I", order)
+        ranks = array.array("I", bytes(4 * len(order)))
+        for rank, row in enumerate(order):
+            ranks[row] = rank
+        words = collections.defaultdict(set)
+        names = collections.defaultdict(set)
+        for row in range(len(store)):
+            self._add(words, names, ranks[row], store.name(row))
+        for geoname_id, name in alternate_names:
+            row = store.row(geoname_id)
+            if row is not None:
+                self._add(words, names, ranks[row], name)
+        # Posting lists of ranks.
+        self._words = dict((word, array.array("I", sorted(postings)))
+                           for word, postings in words.items())
+        self._names = dict((name, array.array("I", sorted(postings)))
+                           for name, postings in names.items())
+        self._continents = dict(
+                (country, continent)
+                for country, (_, continent) in (country_info or {}).items())
+        self._vocabulary = None
+        self._trigram_sizes = None
+        self._trigram_index = None
+        self._bitmaps = LRUCache(max_size=max_bitmaps)
+
+    @staticmethod
+    def _add(words, names, rank, name):
+        for word in tokenize(name):
+            words[word].add(rank)
+        names[normalize(name)].add(rank)
+
+    @classmethod
+    def from_files(cls, store, dump_path=None, alternate_names_path=None,
+                   country_info_path=None, languages=None):
+        """Build an index from GeoNames files.
+
+        :param store: A :class:`geogotchi.local.LocalGeonames`.
+        :param dump_path: The dump `store` was loaded from, to index its
+                          ASCII and alternate names.
+        :param alternate_names_path: ``alternateNames.txt``.
+        :param country_info_path: ``countryInfo.txt``.
+        :param languages: See :func:`read_alternate_names`.
+        """
+        sources = []
+        if dump_path is not None:
+            sources.append(read_dump_alternate_names(dump_path))
+        if alternate_names_path is not None:
+            sources.append(read_alternate_names(alternate_names_path,
+                                                languages))
+        country_info = None
+        if country_info_path is not None:
+            country_info = read_country_info(country_info_path)
+        return cls(store, itertools.chain(*sources), country_info)
+
+    def search(self, q=None, name=None, name_equals=None, max_rows=None,
+               start_row=None, country=None, country_bias=None,
+               continent_code=None, feature_class=None, feature_code=None,
+               operator="AND", fuzzy=1.0, exclude_ids=None, **kwargs):
+        """Search by name.
+
+        Takes the keyword arguments of :meth:`geogotchi.Geogotchi.search`.
+        `q` and `name` both search names and alternate names. `country`,
+        `feature_class` and `feature_code` may be lists. `lang` and `style`
+        are ignored.
+
+        :param exclude_ids: Set of geoname ids to skip.
+        """
+        if q is None and name is None and name_equals is None:
+            raise errors.InvalidParameter(
+                    "one of q, name and name_equals is required")
+        fuzzy = float(fuzzy)
+        operator = operator.upper()
+        if operator not in ("AND", "OR"):
+            raise errors.InvalidParameter("invalid operator: %s" % operator)
+
+        # Each term is a list of posting lists, matching rows in any of
+        # them. Rows must match every term.
+        terms = []
+        for query in (q, name):
+            if query is not None:
+                terms.extend(self._terms(tokenize(query), operator, fuzzy))
+        if name_equals is not None:
+            terms.append([self._names.get(normalize(name_equals), ())])
+        start_row = int(start_row or 0)
+        max_rows = DEFAULT_MAX_ROWS if max_rows is None else int(max_rows)
+        wanted = start_row + max_rows
+        bitmaps = self._filters(country, continent_code, feature_class,
+                                feature_code)
+        bias = None
+        if country_bias is not None:
+            bias = self._bitmap("countries", country_bias)
+        if max_rows <= 0 or not all(any(term) for term in terms):
+            return []
+        if len(terms) == 1:
+            ranks = _union(terms[0])
+        else:
+            # Intersections are usually small, and cheaper to build with
+            # sets than to probe for each rank of the shortest term.
+            matches = [set().union(*term) for term in terms]
+            matches.sort(key=len)
+            ranks = sorted(matches[0].intersection(*matches[1:]))
+
+        rows = self._rows
+        store = self._store
+        found = []
+        unbiased = []
+        for rank in ranks:
+            row = rows[rank]
+            if not all(bitmap[row] for bitmap in bitmaps):
+                continue
+            if exclude_ids and store.geoname_id(row) in exclude_ids:
+                continue
+            if bias is not None and not bias[row]:
+                if len(unbiased) < wanted:
+                    unbiased.append(row)
+                continue
+            found.append(row)
+            if len(found) == wanted:
+                break
+        found.extend(unbiased[:wanted - len(found)])
+        return [store.record(row) for row in found[start_row:]]
+
+    def _terms(self, words, operator, fuzzy):
+        # Terms of the words of a query.
+        terms = [[self._words[match] for match in self._expand(word, fuzzy)]
+                 for word in words]
+        if not terms:
+            return [[]]
+        if operator == "OR":
+            return [list(itertools.chain(*terms))]
+        return terms
+
+    def _expand(self, word, fuzzy):
+        # Indexed words matching `word`. Fuzzy matches have at least a
+        # `fuzzy` share of their trigrams in common with it.
+        if fuzzy >= 1.0:
+            return [word] if word in self._words else []
+        if self._trigram_index is None:
+            self._build_trigram_index()
+        trigrams = _trigrams(word)
+        shared = collections.defaultdict(int)
+        for trigram in trigrams:
+            for i in self._trigram_index.get(trigram, ()):
+                shared[i] += 1
+        vocabulary = self._vocabulary
+        sizes = self._trigram_sizes
+        n = len(trigrams)
+        return [vocabulary[i] for i, count in shared.items()
+                if count >= fuzzy * (n + sizes[i] - count)]
+
+    def _build_trigram_index(self):
+        vocabulary = sorted(self._words)
+        sizes = array.array("I")
+        index = collections.defaultdict(lambda: array.array("I"))
+        for i, word in enumerate(vocabulary):
+            trigrams = _trigrams(word)
+            sizes.append(len(trigrams))
+            for trigram in trigrams:
+                index[trigram].append(i)
+        self._vocabulary = vocabulary
+        self._trigram_sizes = sizes
+        self._trigram_index = dict(index)
+
+    def _filters(self, country, continent_code, feature_class, feature_code):
+        bitmaps = []
+        if country is not None:
+            bitmaps.append(self._bitmap("countries", country))
+        if continent_code is not None:
+            continents = self._continents
+            if not continents:
+                raise errors.GeogotchiError(
+                        "continent_code requires country_info")
+            countries = [c for c, continent in continents.items()
+                         if continent in _as_list(continent_code)]
+            bitmaps.append(self._bitmap("countries", countries))
+        if feature_class is not None:
+            bitmaps.append(self._bitmap("feature_classes", feature_class))
+        if feature_code is not None:
+            bitmaps.append(self._bitmap("feature_codes", feature_code))
+        return bitmaps
+
+    def _bitmap(self, kind, values):
+        key = (kind, frozenset(_as_list(values)))
+        bitmap = self._bitmaps.get(key)
+        if bitmap is None:
+            values = key[1]
+            if kind == "countries":
+                bitmap = self._store.mask(
+                        "countries", lambda value: value in values)
+            elif kind == "feature_classes":
+                bitmap = self._store.mask(
+                        "features",
+                        lambda value: value.split(".", 1)[0] in values)
+            else:
+                bitmap = self._store.mask(
+                        "features",
+                        lambda value: value.split(".", 1)[1] in values)
+            self._bitmaps.set(key, bitmap)
+        return bitmap
@@ -0,0 +1,67 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Reverse geocoding of GPS tracks.
+
+Consecutive points of a track mostly resolve to the same place, so a point
+is only looked up when the track has moved away from the last looked up
+point, or when that lookup is too old.
+"""
+
+from geogotchi import geo
+
+# Default max distance in km from the last looked up point.
+DEFAULT_THRESHOLD = 0.5
+
+
+def resolve_track(lookup, latlons, timestamps=None,
+                  threshold=DEFAULT_THRESHOLD, max_age=None):
+    """Reverse geocode the points of a track.
+
+    :param lookup: Function taking a latitude/longitude two-tuple, e.g.
+                   :meth:`geogotchi.Geogotchi.find_nearby_place` or
+                   :meth:`geogotchi.local.LocalGeonames.find_nearby_place`.
+    :param latlons: Latitude/longitude two-tuples, in track order.
+    :param timestamps: Optional timestamps in seconds, one per point.
+    :param threshold: Distance in km the track may move from the last looked
+                      up point before a new lookup is done.
+    :param max_age: Seconds a lookup is reused for, or ``None``. Requires
+                    `timestamps`.
+    :returns: A list with the result of each point. Points served by the
+              same lookup share the same result object.
+    """
+    if timestamps is not None:
+        latlons = list(latlons)
+        timestamps = list(timestamps)
+        if len(latlons) != len(timestamps):
+            raise ValueError("latlons and timestamps differ in length")
+    elif max_age is not None:
+        raise ValueError("max_age requires timestamps")
+    results = []
+    anchor = anchor_time = result = None
+    for i, latlon in enumerate(latlons):
+        timestamp = timestamps[i] if timestamps is not None else None
+        if (anchor is None or geo.distance(anchor, latlon) > threshold or
+                (max_age is not None and timestamp - anchor_time > max_age)):
+            result = lookup(latlon)
+            anchor = latlon
+            anchor_time = timestamp
+        results.append(result)
+    return results
@@ -0,0 +1,188 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Recording and replaying of API responses.
+
+:class:`RecordingSession` and :class:`ReplaySession` are passed to
+:class:`geogotchi.Geogotchi` as its session. Responses are kept in an
+append-only file with one JSON object per line, keyed like the response
+cache, by API path and parameters except the username::
+
+    >>> gg = Geogotchi(session=RecordingSession("backfill.jsonl"))
+    >>> # ... later, offline and at disk speed:
+    >>> gg = Geogotchi(session=ReplaySession("backfill.jsonl"))
+"""
+
+import base64
+import json
+import threading
+
+import requests
+from requests.compat import urlparse
+
+from geogotchi.cache import request_key
+from geogotchi import errors
+
+
+def _key(url, params):
+    path = urlparse(url).path.rsplit("/", 1)[-1]
+    return request_key(path, params or {})
+
+
+class ReplayedResponse(object):
+    """Response read from a recording.
+    """
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+
+class _Journal(object):
+    # Append-only file of recorded responses.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def read(self):
+        """Recorded responses by key. Later recordings of a key win.
+        """
+        responses = {}
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return responses
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    # Partly written line of an interrupted recording.
+                    continue
+                if "body64" in entry:
+                    content = base64.b64decode(entry["body64"])
+                else:
+                    content = entry["body"].encode("utf-8")
+                responses[entry["key"]] = ReplayedResponse(entry["status"],
+                                                           content)
+        return responses
+
+    def append(self, key, response):
+        entry = {"key": key, "status": response.status_code}
+        try:
+            entry["body"] = response.content.decode("utf-8")
+        except UnicodeDecodeError:
+            # E.g. an error page from a proxy. Kept as is, base64 encoded.
+            entry["body64"] = base64.b64encode(
+                    response.content).decode("ascii")
+        line = json.dumps(entry, separators=(",", ":"))
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            self._file.write(line.encode("utf-8") + b"\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class RecordingSession(object):
+    """Session recording every response to a file.
+
+    :param path: Path of the recording, appended to if it exists.
+    :param session: Session doing the requests. Defaults to a new
+                    :class:`requests.Session`.
+    """
+
+    def __init__(self, path, session=None):
+        self._session = session if session is not None else requests.Session()
+        self._journal = _Journal(path)
+
+    def get(self, url, params=None, **kwargs):
+        response = self._session.get(url, params=params, **kwargs)
+        self._journal.append(_key(url, params), response)
+        return response
+
+    def close(self):
+        self._journal.close()
+        self._session.close()
+
+
+class ReplaySession(object):
+    """Session answering from a recording.
+
+    The recording is read into memory when the session is created.
+
+    :param path: Path of a recording made by :class:`RecordingSession`.
+    :param on_miss: What to do with requests missing from the recording:
+                    ``"error"`` raises :class:`geogotchi.errors.ReplayMiss`,
+                    ``"passthrough"`` does the request, and ``"record"``
+                    does the request and adds the response to the
+                    recording.
+    :param session: Session doing passed through requests. Defaults to a
+                    new :class:`requests.Session`.
+    """
+
+    def __init__(self, path, on_miss="error", session=None):
+        if on_miss not in ("error", "passthrough", "record"):
+            raise ValueError("invalid on_miss: %r" % on_miss)
+        self.on_miss = on_miss
+        self._journal = _Journal(path)
+        self._responses = self._journal.read()
+        self._session = session
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._responses)
+
+    def get(self, url, params=None, **kwargs):
+        key = _key(url, params)
+        response = self._responses.get(key)
+        with self._lock:
+            if response is not None:
+                self.hits += 1
+                return response
+            self.misses += 1
+            if self.on_miss == "error":
+                raise errors.ReplayMiss("not in recording: %s" % key)
+            if self._session is None:
+                self._session = requests.Session()
+        response = self._session.get(url, params=params, **kwargs)
+        if self.on_miss == "record":
+            self._journal.append(key, response)
+            self._responses[key] = ReplayedResponse(response.status_code,
+                                                    response.content)
+        return response
+
+    def close(self):
+        self._journal.close()
+        if self._session is not None:
+            self._session.close()
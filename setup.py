@@ -19,10 +19,20 @@ setup(name="geogotchi",
           "Intended Audience :: Developers",
           "License :: OSI Approved :: MIT License",
           "Operating System :: OS Independent",
-          "Programming Language :: Python :: 2",
-          "Programming Language :: Python :: 2.7",
+          "Programming Language :: Python :: 3",
+          "Programming Language :: Python :: 3 :: Only",
           ],
+      python_requires=">=3.7",
       install_requires=[
-          'requests>=0.12.1',
-          ])
+          'requests>=1.0',
+          ],
+      extras_require={
+          "async": ["aiohttp"],
+          "speedups": ["orjson"],
+          },
+      entry_points={
+          "console_scripts": [
+              "geogotchi-bulk = geogotchi.cli:main",
+              ],
+          })
 
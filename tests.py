@@ -20,13 +20,40 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
+import io
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 from operator import itemgetter
 
 from geogotchi import Geogotchi
 from geogotchi import errors
+from geogotchi.aio import AsyncGeogotchi
+from geogotchi.cache import HierarchyCache
+from geogotchi import cli
+from geogotchi.cache import LRUCache
+from geogotchi.cache import MemoryCache
+from geogotchi.cache import SQLiteCache
+from geogotchi.cache import NearbyCache
+from geogotchi.hierarchy import LocalHierarchy
+from geogotchi.metrics import Metrics
+from geogotchi.local import LocalGeonames
+from geogotchi import ranking
+from geogotchi.ratelimit import RateLimiter
+from geogotchi.refresh import Dataset
+from geogotchi.refresh import LiveDataset
+from geogotchi.refresh import Updater
+from geogotchi.resolver import TieredResolver
+from geogotchi.retry import RetryPolicy
+from geogotchi.search import LocalSearch
+from geogotchi.transport import RecordingSession
+from geogotchi.transport import ReplaySession
 from geogotchi.constants import DEFAULT_USERNAME
 import geogotchi.base
 
@@ -37,6 +64,8 @@ latlons = {
         "uppsala": (59.859, 17.645),
         "lkpg": (58.411, 15.622),
         }
+testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "testdata")
 username = os.environ.get("GEOGOTCHI_USERNAME", DEFAULT_USERNAME)
 gg = Geogotchi(username=username)
 
@@ -44,6 +73,54 @@ def get_random_string():
     return uuid.uuid4().hex
 
 
+class FakeResponse(object):
+
+    def __init__(self, payload, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(payload)
+        self.content = self.text.encode("utf-8")
+
+
+class FakeSession(object):
+    """Stands in for a requests session, returning canned payloads.
+
+    `failures` is a list of (payload, status_code) pairs returned by the
+    first calls, before the regular payload.
+    """
+
+    def __init__(self, payload=None, status_code=200, failures=()):
+        self.payload = payload if payload is not None else {"geonames": []}
+        self.status_code = status_code
+        self.failures = list(failures)
+        self.calls = []
+        self.closed = False
+
+    def get(self, url, params=None, **kwargs):
+        self.calls.append((url, dict(params or {})))
+        if self.failures:
+            return FakeResponse(*self.failures.pop(0))
+        return FakeResponse(self.payload, self.status_code)
+
+    def close(self):
+        self.closed = True
+
+
+class BlockingSession(FakeSession):
+    """FakeSession whose requests wait until `release` is set.
+    """
+
+    def __init__(self, *args, **kwargs):
+        FakeSession.__init__(self, *args, **kwargs)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def get(self, url, params=None, **kwargs):
+        response = FakeSession.get(self, url, params, **kwargs)
+        self.started.set()
+        self.release.wait(5)
+        return response
+
+
 class TestGeogotchi(unittest.TestCase):
 
     def test_invalid_username(self):
@@ -132,3 +209,741 @@ class TestGeogotchi(unittest.TestCase):
         should_exist = [u"Elite Hotel Knaust", u"First Hotel Strand"]
         existing = [n for n in names if n in should_exist]
         self.assertTrue(existing)
+
+
+class FakeAsyncResponse(object):
+
+    def __init__(self, payload, status):
+        self.status = status
+        self._body = json.dumps(payload).encode("utf-8")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def read(self):
+        return self._body
+
+
+class FakeAsyncSession(FakeSession):
+
+    def get(self, url, params=None, **kwargs):
+        self.calls.append((url, dict(params or {})))
+        return FakeAsyncResponse(self.payload, self.status_code)
+
+
+class TestGeogotchiOffline(unittest.TestCase):
+
+    def test_session_is_reused(self):
+        session = FakeSession({"geonames": [{"name": "Stockholm",
+                                             "distance": "0.5"}]})
+        gg_fake = Geogotchi(username="test", session=session)
+        gg_fake.find_nearby_place(latlons["sthlm"])
+        gg_fake.get_hierarchy(2673730)
+        self.assertEqual(2, len(session.calls))
+        url, params = session.calls[0]
+        self.assertTrue(url.endswith("findNearbyPlaceNameJSON"))
+        self.assertEqual("test", params["username"])
+
+    def test_base_url(self):
+        session = FakeSession()
+        gg_fake = Geogotchi(username="test", session=session,
+                            base_url="http://localhost:8080/")
+        gg_fake.find_nearby_toponym(latlons["sthlm"])
+        self.assertEqual("http://localhost:8080/findNearbyJSON",
+                         session.calls[0][0])
+
+    def test_close(self):
+        closed = []
+        with Geogotchi(username="test") as gg_owned:
+            gg_owned._session.close = lambda: closed.append(True)
+        self.assertTrue(closed)
+
+        session = FakeSession()
+        with Geogotchi(username="test", session=session):
+            pass
+        self.assertFalse(session.closed)
+
+    def test_nearby_cache(self):
+        session = FakeSession({"geonames": [{"name": "Stockholm",
+                                             "distance": "0.5"}]})
+        gg_fake = Geogotchi(username="test", session=session,
+                            nearby_cache=NearbyCache(resolution=0.01))
+        first = gg_fake.find_nearby_place((59.3331, 18.0651))
+        second = gg_fake.find_nearby_place((59.3339, 18.0659))
+        self.assertEqual(first, second)
+        self.assertEqual(1, len(session.calls))
+        gg_fake.find_nearby_place((59.3331, 18.0651), radius=5)
+        gg_fake.find_nearby_toponym((59.3331, 18.0651))
+        gg_fake.find_nearby_place((59.4331, 18.0651))
+        self.assertEqual(4, len(session.calls))
+
+    def test_lru_cache_eviction_and_ttl(self):
+        now = [0.0]
+        cache = LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        now[0] = 11.0
+        self.assertEqual(None, cache.get("a"))
+
+    def test_find_nearby_place_many(self):
+        session = FakeSession({"geonames": [{"name": "Stockholm",
+                                             "distance": "0.5"}]})
+        gg_fake = Geogotchi(username="test", session=session)
+        points = [latlons[k] for k in sorted(latlons)] + [None]
+        results = gg_fake.find_nearby_place_many(points, max_workers=3)
+        self.assertEqual(points, [r.latlon for r in results])
+        for result in results[:-1]:
+            self.assertEqual(None, result.error)
+            self.assertEqual("Stockholm", result.geonames[0]["name"])
+        self.assertTrue(isinstance(results[-1].error, TypeError))
+        self.assertEqual(None, results[-1].geonames)
+        self.assertEqual(len(latlons), len(session.calls))
+
+    def test_async_client(self):
+        session = FakeAsyncSession({"geonames": [
+                {"title": "a", "rank": 10, "distance": "2.0"},
+                {"title": "b", "rank": 90, "distance": "1.0"}]})
+        async def run():
+            async with AsyncGeogotchi(username="test",
+                                      session=session) as agg:
+                return await asyncio.gather(
+                        agg.find_nearby_wikipedia(latlons["sthlm"]),
+                        agg.search(q="Sweden"))
+        nearby, _ = asyncio.run(run())
+        self.assertEqual(["b", "a"], [n["title"] for n in nearby])
+        self.assertEqual(1.0, nearby[0]["distance"])
+        self.assertEqual(2, len(session.calls))
+        self.assertFalse(session.closed)
+
+    def test_async_client_error(self):
+        session = FakeAsyncSession({"status": {"value": 10,
+                                               "message": "no user"}})
+        agg = AsyncGeogotchi(username="test", session=session)
+        self.assertRaises(errors.AuthorizationException, asyncio.run,
+                          agg.get_hierarchy(2673730))
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        limiter = RateLimiter(hourly=2, daily=None, costs={"searchJSON": 2},
+                              clock=lambda: now[0], sleep=sleep)
+        session = FakeSession()
+        gg_fake = Geogotchi(username="test", session=session,
+                            rate_limiter=limiter)
+        gg_fake.find_nearby_place(latlons["sthlm"])
+        gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual([], sleeps)
+        gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual([1800.0], sleeps)
+        self.assertRaises(errors.RateLimitExceeded, limiter.acquire,
+                          "searchJSON", block=False)
+        self.assertEqual(3, len(session.calls))
+
+    def test_retry_policy(self):
+        sleeps = []
+        policy = RetryPolicy(max_attempts=4, backoff=1.0, jitter=False,
+                             sleep=sleeps.append)
+        overloaded = {"status": {"value": 22, "message": "overloaded"}}
+        session = FakeSession(failures=[(overloaded, 200), ({}, 503)])
+        gg_fake = Geogotchi(username="test", session=session,
+                            retry_policy=policy)
+        self.assertEqual([], gg_fake.find_nearby_place(latlons["sthlm"]))
+        self.assertEqual([1.0, 2.0], sleeps)
+
+        session = FakeSession(failures=[({}, 404)])
+        gg_fake = Geogotchi(username="test", session=session,
+                            retry_policy=policy)
+        self.assertRaises(errors.HTTPError, gg_fake.get_hierarchy, 1)
+        self.assertEqual(1, len(session.calls))
+
+    def test_retry_policy_deadline(self):
+        now = [0.0]
+        def sleep(seconds):
+            now[0] += seconds
+        policy = RetryPolicy(max_attempts=10, backoff=1.0, jitter=False,
+                             deadline=5.0, clock=lambda: now[0], sleep=sleep)
+        session = FakeSession({}, 503)
+        gg_fake = Geogotchi(username="test", session=session,
+                            retry_policy=policy)
+        self.assertRaises(errors.HTTPError, gg_fake.get_hierarchy, 1)
+        self.assertEqual(3, len(session.calls))
+
+    def test_hierarchy_cache(self):
+        hierarchy = [{"geonameId": 6295630, "name": "Earth"},
+                     {"geonameId": 6255148, "name": "Europe"},
+                     {"geonameId": 2661886, "name": "Sweden"}]
+        session = FakeSession({"geonames": hierarchy})
+        gg_fake = Geogotchi(username="test", session=session,
+                            hierarchy_cache=HierarchyCache())
+        self.assertEqual(hierarchy, gg_fake.get_hierarchy(2661886))
+        self.assertEqual(hierarchy[:2],
+                         gg_fake.get_hierarchy({"geonameId": 6255148}))
+        self.assertEqual(1, len(session.calls))
+
+        session.payload = {"geonames": [dict(g) for g in hierarchy[:2]] +
+                                        [{"geonameId": 3144096,
+                                          "name": "Norway"}]}
+        norway = gg_fake.get_hierarchy(3144096)
+        self.assertEqual(2, len(session.calls))
+        sweden = gg_fake.get_hierarchy(2661886)
+        self.assertTrue(norway[1] is sweden[1])
+
+    def test_ranking(self):
+        nearby = [{"title": str(i), "rank": i % 7 * 10, "distance": i % 5}
+                  for i in range(100)]
+        def titles(entries):
+            return [e["title"] for e in entries]
+        by_rank = ranking.rank(nearby, 1.0, 0.0)
+        self.assertEqual(60, by_rank[0]["rank"])
+        self.assertEqual(0, by_rank[-1]["rank"])
+        # Ties keep the order of a stable ascending sort, reversed.
+        self.assertEqual(["97", "90", "83"], titles(by_rank[:3]))
+        self.assertEqual(titles(by_rank[:10]),
+                         titles(ranking.rank(nearby, 1.0, 0.0, top_k=10)))
+        many = ranking.rank_many(nearby, [(1.0, 0.0), (0.0, 1.0)], top_k=5)
+        self.assertEqual(titles(by_rank[:5]), titles(many[0]))
+        self.assertEqual(0, many[1][0]["distance"])
+
+    def test_iter_search(self):
+        class PagedSession(FakeSession):
+            def get(self, url, params=None, **kwargs):
+                self.calls.append((url, dict(params)))
+                start, rows = params["startRow"], params["maxRows"]
+                end = min(start + rows, 25)
+                return FakeResponse({"totalResultsCount": 25,
+                                     "geonames": [{"geonameId": i}
+                                                  for i in range(start, end)]})
+        for prefetch in [True, False]:
+            session = PagedSession()
+            gg_fake = Geogotchi(username="test", session=session)
+            found = gg_fake.iter_search(q="hotel", page_size=10,
+                                        prefetch=prefetch)
+            self.assertEqual(list(range(25)),
+                             [g["geonameId"] for g in found])
+            self.assertEqual([0, 10, 20],
+                             [p["startRow"] for _, p in session.calls])
+
+        session = PagedSession()
+        gg_fake = Geogotchi(username="test", session=session)
+        found = list(gg_fake.iter_search(q="hotel", page_size=10,
+                                         start_row=5, max_rows=12))
+        self.assertEqual(list(range(5, 17)), [g["geonameId"] for g in found])
+        self.assertEqual([(5, 10), (15, 2)],
+                         [(p["startRow"], p["maxRows"])
+                          for _, p in session.calls])
+
+    def test_numeric_fields(self):
+        session = FakeSession({"geonames": [
+                {"name": "Stockholm", "lat": "59.33", "lng": "18.06",
+                 "distance": "0.5", "population": "1515017"},
+                {"name": "Nowhere", "population": ""}]})
+        gg_fake = Geogotchi(username="test", session=session)
+        nearby = gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual((59.33, 18.06), (nearby[0]["lat"], nearby[0]["lng"]))
+        self.assertEqual(0.5, nearby[0]["distance"])
+        self.assertEqual(1515017, nearby[0]["population"])
+        self.assertEqual("", nearby[1]["population"])
+
+    def test_records(self):
+        session = FakeSession({"geonames": [
+                {"geonameId": 2673730, "name": "Stockholm", "lat": "59.33",
+                 "distance": "0.5", "fcodeName": "capital"}]})
+        gg_fake = Geogotchi(username="test", session=session, records=True)
+        geoname = gg_fake.find_nearby_place(latlons["sthlm"])[0]
+        self.assertEqual(2673730, geoname.geoname_id)
+        self.assertEqual(59.33, geoname["lat"])
+        self.assertEqual("capital", geoname["fcodeName"])
+        self.assertEqual({"geonameId": 2673730, "name": "Stockholm",
+                          "lat": 59.33, "distance": 0.5,
+                          "fcodeName": "capital"}, dict(geoname))
+        self.assertFalse("lng" in geoname)
+        self.assertRaises(KeyError, lambda: geoname["lng"])
+        self.assertRaises(AttributeError, setattr, geoname, "foo", 1)
+
+    def test_response_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "cache.sqlite")
+        payload = {"geonames": [{"name": "Stockholm", "distance": "0.5"}]}
+        session = FakeSession(payload)
+        gg_fake = Geogotchi(username="test", session=session,
+                            response_cache=SQLiteCache(path))
+        first = gg_fake.find_nearby_place(latlons["sthlm"])
+        # Another client and account share the cache file.
+        gg_other = Geogotchi(username="other", session=session,
+                             response_cache=SQLiteCache(path))
+        self.assertEqual(first, gg_other.find_nearby_place(latlons["sthlm"]))
+        self.assertEqual(1, len(session.calls))
+        gg_other.find_nearby_place(latlons["sthlm"], radius=5)
+        self.assertEqual(2, len(session.calls))
+
+    def test_sqlite_cache_expiry_and_eviction(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        now = [0.0]
+        cache = SQLiteCache(os.path.join(tmpdir, "cache.sqlite"), ttl=10,
+                            max_size=2, clock=lambda: now[0])
+        cache.set("a", b"1")
+        cache.set("b", b"2", ttl=20)
+        cache.set("c", b"3", ttl=30)
+        self.assertEqual(b"1", cache.get("a"))
+        cache.evict()
+        self.assertEqual(None, cache.get("a"))
+        self.assertEqual(b"2", cache.get("b"))
+        now[0] = 25.0
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(b"3", cache.get("c"))
+
+    def test_negative_cache(self):
+        now = [0.0]
+        payload = {"status": {"message": "no result", "value": 15}}
+        session = FakeSession(payload)
+        gg_fake = Geogotchi(username="test", session=session,
+                            response_cache=MemoryCache(clock=lambda: now[0]),
+                            negative_ttl=60)
+        for _ in range(2):
+            with self.assertRaises(errors.NoResultFound):
+                gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual(1, len(session.calls))
+        now[0] = 61.0
+        session.payload = {"geonames": [{"name": "Stockholm"}]}
+        geonames = gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual("Stockholm", geonames[0]["name"])
+        self.assertEqual(2, len(session.calls))
+        # Other errors are not cached.
+        session.payload = {"status": {"message": "timeout", "value": 13}}
+        for _ in range(2):
+            with self.assertRaises(errors.DatabaseTimeout):
+                gg_fake.find_nearby_place(latlons["uppsala"])
+        self.assertEqual(4, len(session.calls))
+
+    def test_stale_while_revalidate(self):
+        now = [0.0]
+        session = FakeSession({"geonames": [{"name": "Old"}]})
+        metrics = Metrics()
+        cache = MemoryCache(ttl=10, stale_ttl=100, clock=lambda: now[0])
+        gg_fake = Geogotchi(username="test", session=session,
+                            response_cache=cache, metrics=metrics)
+        gg_fake.find_nearby_place(latlons["sthlm"])
+        now[0] = 20.0
+        session.payload = {"geonames": [{"name": "New"}]}
+        geonames = gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual("Old", geonames[0]["name"])
+        # Wait for the background refresh.
+        gg_fake._revalidator.shutdown()
+        self.assertEqual(2, len(session.calls))
+        self.assertEqual(1, metrics.counter("response_cache.stale",
+                                            "findNearbyPlaceNameJSON"))
+        geonames = gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual("New", geonames[0]["name"])
+        self.assertEqual(2, len(session.calls))
+        # Past the stale TTL, calls wait for a fresh response.
+        now[0] = 200.0
+        gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual(3, len(session.calls))
+        # Closed clients serve stale responses without refreshing them.
+        gg_fake.close()
+        now[0] = 250.0
+        gg_fake.find_nearby_place(latlons["sthlm"])
+        self.assertEqual(3, len(session.calls))
+        self.assertEqual(None, gg_fake._revalidator)
+
+    def test_find_nearby_place_track(self):
+        session = FakeSession({"geonames": [{"name": "Stockholm"}]})
+        gg_fake = Geogotchi(username="test", session=session)
+        # Roughly 50 m steps east, then a jump to Uppsala.
+        points = [(59.333, 18.065 + 0.0009 * i) for i in range(5)]
+        points.append(latlons["uppsala"])
+        results = gg_fake.find_nearby_place_track(points, threshold=0.1)
+        self.assertEqual(6, len(results))
+        self.assertEqual(4, len(session.calls))
+        self.assertTrue(results[0] is results[1])
+        self.assertFalse(results[1] is results[2])
+        # Lookups older than max_age are not reused.
+        session.calls = []
+        gg_fake.find_nearby_place_track(points[:2], timestamps=[0, 60],
+                                        threshold=0.1, max_age=30)
+        self.assertEqual(2, len(session.calls))
+        self.assertRaises(ValueError, gg_fake.find_nearby_place_track,
+                          points, max_age=30)
+
+    def test_metrics(self):
+        payload = {"geonames": [{"name": "Stockholm", "distance": "0.5",
+                                 "rank": 90}]}
+        session = FakeSession(payload, failures=[({}, 503)])
+        metrics = Metrics()
+        gg_fake = Geogotchi(username="test", session=session,
+                            nearby_cache=NearbyCache(), metrics=metrics,
+                            retry_policy=RetryPolicy(sleep=lambda s: None))
+        path = "findNearbyWikipediaJSON"
+        gg_fake.find_nearby_wikipedia(latlons["sthlm"])
+        gg_fake.find_nearby_wikipedia(latlons["sthlm"])
+        self.assertEqual(2, metrics.counter("requests", path))
+        self.assertEqual(1, metrics.counter("retries", path))
+        self.assertEqual(len(session.calls), metrics.counter("requests", path))
+        self.assertTrue(metrics.counter("bytes", path) > 0)
+        self.assertEqual(2, metrics.histogram("network", path).count)
+        self.assertEqual(2, metrics.histogram("ranking", path).count)
+        self.assertEqual(0.5, metrics.hit_ratio("nearby_cache", path))
+        session.payload = {"status": {"value": 15}}
+        self.assertRaises(errors.NoResultFound, gg_fake.search, q="x")
+        self.assertEqual({"searchJSON": 1},
+                         metrics.snapshot()["errors.NoResultFound"])
+
+    def test_record_and_replay(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "recording.jsonl")
+        payload = {"geonames": [{"name": u"Malm\xf6", "distance": "0.5"}]}
+        recording = RecordingSession(path, session=FakeSession(payload))
+        gg_fake = Geogotchi(username="test", session=recording)
+        recorded = gg_fake.find_nearby_place(latlons["malmo"])
+        recording.close()
+
+        replay = ReplaySession(path)
+        gg_fake = Geogotchi(username="other", session=replay)
+        self.assertEqual(recorded, gg_fake.find_nearby_place(latlons["malmo"]))
+        self.assertRaises(errors.ReplayMiss, gg_fake.find_nearby_place,
+                          latlons["lkpg"])
+
+        session = FakeSession(payload)
+        replay = ReplaySession(path, on_miss="record", session=session)
+        gg_fake = Geogotchi(username="test", session=replay)
+        gg_fake.find_nearby_place(latlons["malmo"])
+        gg_fake.find_nearby_place(latlons["lkpg"])
+        gg_fake.find_nearby_place(latlons["lkpg"])
+        replay.close()
+        self.assertEqual(1, len(session.calls))
+        self.assertEqual(2, len(ReplaySession(path)))
+
+    def test_record_non_utf8_response(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "recording.jsonl")
+        response = FakeResponse(None, 503)
+        response.content = b"<html>\xe9</html>"
+        session = FakeSession()
+        session.get = lambda url, params=None, **kwargs: response
+        recording = RecordingSession(path, session=session)
+        gg_fake = Geogotchi(username="test", session=recording)
+        self.assertRaises(errors.HTTPError, gg_fake.search, q="x")
+        recording.close()
+        gg_fake = Geogotchi(username="test", session=ReplaySession(path))
+        with self.assertRaises(errors.HTTPError) as cm:
+            gg_fake.search(q="x")
+        self.assertEqual(503, cm.exception.status_code)
+
+    def test_coalesce(self):
+        payload = {"geonames": [{"name": "Stockholm", "distance": "0.5"}]}
+        session = BlockingSession(payload)
+        gg_fake = Geogotchi(username="test", session=session, coalesce=True)
+        results = []
+        threads = [threading.Thread(
+                target=lambda: results.append(
+                    gg_fake.find_nearby_place(latlons["sthlm"])))
+                for _ in range(4)]
+        threads[0].start()
+        session.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        session.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(session.calls))
+        self.assertEqual(4, len(results))
+        self.assertEqual([results[0]] * 4, results)
+        # Each caller gets its own list.
+        self.assertEqual(4, len(set(map(id, results))))
+        # Errors are shared too, and nothing stays in flight.
+        session = FakeSession({"status": {"value": 15}})
+        gg_fake = Geogotchi(username="test", session=session, coalesce=True)
+        self.assertRaises(errors.NoResultFound, gg_fake.search, q="x")
+        self.assertRaises(errors.NoResultFound, gg_fake.search, q="x")
+        self.assertEqual(2, len(session.calls))
+
+
+class TestLocalGeonames(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.local = LocalGeonames.from_dump(
+                os.path.join(testdata, "cities.txt"))
+        cls.hierarchy = LocalHierarchy.from_files(
+                cls.local,
+                os.path.join(testdata, "hierarchy.txt"),
+                admin1_path=os.path.join(testdata, "admin1CodesASCII.txt"),
+                admin2_path=os.path.join(testdata, "admin2Codes.txt"),
+                country_info_path=os.path.join(testdata, "countryInfo.txt"))
+        cls.search = LocalSearch.from_files(
+                cls.local,
+                dump_path=os.path.join(testdata, "cities.txt"),
+                alternate_names_path=os.path.join(testdata,
+                                                  "alternateNames.txt"),
+                country_info_path=os.path.join(testdata, "countryInfo.txt"))
+
+    def test_find_nearby_place(self):
+        nearby = self.local.find_nearby_place(latlons["lkpg"])
+        self.assertEqual([u"Link\xf6ping"], [n["name"] for n in nearby])
+        self.assertTrue(nearby[0]["distance"] < 0.1)
+        nearby = self.local.find_nearby_place(latlons["sthlm"], radius=50,
+                                              max_rows=5)
+        self.assertEqual([u"Stockholm", u"Solna"],
+                         [n["name"] for n in nearby])
+
+    def test_find_nearby_toponym(self):
+        nearby = self.local.find_nearby_toponym(latlons["lkpg"], radius=5,
+                                                max_rows=3)
+        self.assertEqual([2694762, 8128618],
+                         [n["geonameId"] for n in nearby])
+        distances = [n["distance"] for n in nearby]
+        self.assertEqual(sorted(distances), distances)
+
+    def test_get(self):
+        self.assertEqual(u"Uppsala", self.local.get(2666199)["name"])
+        self.assertEqual(None, self.local.get(1))
+
+    def test_save_and_open(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "store.bin")
+        self.local.save(path)
+        with LocalGeonames.open(path) as mapped:
+            self.assertEqual(len(self.local), len(mapped))
+            for latlon in latlons.values():
+                self.assertEqual(self.local.find_nearby_place(latlon),
+                                 mapped.find_nearby_place(latlon))
+            self.assertEqual(self.local.get(2711537), mapped.get(2711537))
+
+    def test_get_hierarchy(self):
+        geoname = self.local.find_nearby_place(latlons["lkpg"])[0]
+        hierarchy = self.hierarchy.get_hierarchy(geoname)
+        self.assertEqual([u"Earth", u"Europe", u"Sweden",
+                          u"\xd6sterg\xf6tland", u"Link\xf6pings Kommun",
+                          u"Link\xf6ping"],
+                         [g["name"] for g in hierarchy])
+        # Not in hierarchy.txt, resolved through admin codes.
+        hierarchy = self.hierarchy.get_hierarchy(3143244)
+        self.assertEqual([u"Earth", u"Europe", u"Norway", u"Oslo"],
+                         [g["name"] for g in hierarchy])
+        self.assertRaises(errors.RecordDoesNotExist,
+                          self.hierarchy.get_hierarchy, 1)
+
+    def test_get_hierarchies(self):
+        hierarchies = self.hierarchy.get_hierarchies([2673730, 2675408])
+        self.assertEqual(u"Stockholm", hierarchies[0][-1]["name"])
+        self.assertEqual(u"Solna", hierarchies[1][-1]["name"])
+        self.assertTrue(hierarchies[0][3] is hierarchies[1][3])
+
+    def test_search(self):
+        names = lambda geonames: [g["name"] for g in geonames]
+        # Stockholms l\xe4n is also known as Stockholm County.
+        self.assertEqual([u"Stockholms l\xe4n", u"Stockholm"],
+                         names(self.search.search(q="stockholm")))
+        self.assertEqual([u"Stockholm"],
+                         names(self.search.search(q="stockholm",
+                                                  feature_class="P")))
+        self.assertEqual([u"Stockholm"],
+                         names(self.search.search(name="Tukholma")))
+        self.assertEqual([u"G\xf6teborg"],
+                         names(self.search.search(name_equals="goteborg")))
+        self.assertEqual([u"Link\xf6ping"],
+                         names(self.search.search(name="linkoping")))
+        self.assertEqual([u"Uppsala Domkyrka", u"S:t Lars kyrka"],
+                         names(self.search.search(name="uppsala kyrka",
+                                                  operator="OR",
+                                                  feature_code="CH")))
+        self.assertEqual([u"Stockholm"],
+                         names(self.search.search(name="stokholm",
+                                                  fuzzy=0.5,
+                                                  feature_class="P")))
+        self.assertEqual([], self.search.search(name="stokholm"))
+
+    def test_search_filters_and_paging(self):
+        names = lambda geonames: [g["name"] for g in geonames]
+        found = self.search.search(q="oslo norway", operator="OR",
+                                   continent_code="EU")
+        self.assertEqual([u"Norway", u"Oslo"], names(found))
+        found = self.search.search(q="oslo norway", operator="OR",
+                                   country="SE")
+        self.assertEqual([], found)
+        found = self.search.search(q="stockholm", start_row=1, max_rows=1)
+        self.assertEqual([u"Stockholm"], names(found))
+        found = self.search.search(q="stockholm uppsala", operator="OR",
+                                   max_rows=2, country_bias="SE",
+                                   feature_class=["P"])
+        self.assertEqual([u"Stockholm", u"Uppsala"], names(found))
+        self.assertRaises(errors.InvalidParameter, self.search.search)
+
+    def test_tiered_resolver(self):
+        session = FakeSession({"geonames": [{"name": "Remote", "rank": 1,
+                                             "distance": "0.1",
+                                             "geonameId": 1}]})
+        client = Geogotchi(username="test", session=session)
+        resolver = TieredResolver(client, local=self.local,
+                                  hierarchy=self.hierarchy,
+                                  search=self.search)
+        nearby = resolver.find_nearby_place(latlons["lkpg"])
+        self.assertEqual([u"Link\xf6ping"], [n["name"] for n in nearby])
+        self.assertEqual(6, len(resolver.get_hierarchy(2694762)))
+        self.assertEqual(0, len(session.calls))
+        # Misses and short results fall through.
+        resolver.get_hierarchy(1)
+        resolver.search(q="nowhere")
+        resolver.search(q="stockholm", max_rows=5)
+        resolver.find_nearby_wikipedia(latlons["lkpg"])
+        self.assertEqual(4, len(session.calls))
+        self.assertEqual(1, resolver.served["find_nearby_place", "local"])
+        # Points outside the local data fall through too.
+        resolver.find_nearby_place((40.71, -74.0))
+        self.assertEqual(5, len(session.calls))
+        self.assertEqual(1, resolver.served["find_nearby_place", "http"])
+        self.assertEqual(2, resolver.served["search", "http"])
+        stale = TieredResolver(client, local=self.local,
+                               is_stale=lambda: True)
+        stale.find_nearby_place(latlons["lkpg"])
+        self.assertEqual(1, stale.served["find_nearby_place", "http"])
+
+    def test_tiered_resolver_fall_through(self):
+        session = FakeSession({"geonames": [{"name": "Remote", "rank": 1,
+                                             "distance": "0.1",
+                                             "geonameId": 1}]})
+        client = Geogotchi(username="test", session=session, records=True)
+        places = LocalGeonames.from_dump(os.path.join(testdata, "cities.txt"),
+                                         feature_classes="P")
+        hierarchy = LocalHierarchy.from_files(
+                places, os.path.join(testdata, "hierarchy.txt"))
+        resolver = TieredResolver(client, local=self.local,
+                                  hierarchy=hierarchy,
+                                  search=LocalSearch(self.local))
+        # Hierarchies not reaching the Earth, and searches the local index
+        # cannot filter, are answered by the web services.
+        resolver.get_hierarchy(2694762)
+        resolver.search(q="stockholm", continent_code="EU")
+        self.assertEqual(2, len(session.calls))
+        self.assertEqual(1, resolver.served["get_hierarchy", "http"])
+        self.assertEqual(1, resolver.served["search", "http"])
+        # Local results are records, like the client's.
+        nearby = resolver.find_nearby_place(latlons["lkpg"])
+        self.assertEqual(2694762, nearby[0].geoname_id)
+        self.assertEqual(2, len(session.calls))
+
+    def test_cli(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        store = os.path.join(tmpdir, "store")
+        self.local.save(store)
+        points = os.path.join(tmpdir, "points.csv")
+        with io.open(points, "w", encoding="utf-8") as f:
+            f.write(u"id,lat,lng\n")
+            for i, name in enumerate(["lkpg", "sthlm", "gbg", "malmo",
+                                      "uppsala"]):
+                f.write(u"%d,%s,%s\n" % ((i,) + latlons[name]))
+            f.write(u"5,north,east\n")
+        output = os.path.join(tmpdir, "places.jsonl")
+        checkpoint = os.path.join(tmpdir, "checkpoint")
+        args = [points, output, "--local", store, "--workers", "2",
+                "--checkpoint", checkpoint, "--checkpoint-every", "2",
+                "--quiet"]
+        self.assertEqual(0, cli.main(args))
+        with io.open(output, "rb") as f:
+            lines = f.readlines()
+        rows = [json.loads(line.decode("utf-8")) for line in lines]
+        self.assertEqual(list(range(6)), [r["row"] for r in rows])
+        self.assertEqual(u"Link\xf6ping", rows[0]["geonames"][0]["name"])
+        self.assertEqual("4", rows[4]["id"])
+        self.assertTrue(rows[5]["error"].startswith("ValueError"))
+
+        # Resume a run interrupted after two rows, with a partly written
+        # third row.
+        with io.open(output, "r+b") as f:
+            f.truncate(len(lines[0]) + len(lines[1]) + 5)
+        source = cli.input_source(points, "csv")
+        cli.Checkpoint(checkpoint, source).save(
+                2, len(lines[0]) + len(lines[1]))
+        self.assertEqual(0, cli.main(args))
+        with io.open(output, "rb") as f:
+            self.assertEqual(lines, f.readlines())
+        # A missing output is written again from the start.
+        os.remove(output)
+        self.assertEqual(0, cli.main(args))
+        with io.open(output, "rb") as f:
+            self.assertEqual(lines, f.readlines())
+        # The checkpoint is not applied to other inputs.
+        with io.open(points, "a", encoding="utf-8") as f:
+            f.write(u"6,58.411,15.622\n")
+        self.assertEqual(1, cli.main(args))
+
+        # Invalid lines of JSON input are written as errors.
+        points = os.path.join(tmpdir, "points.jsonl")
+        with io.open(points, "w", encoding="utf-8") as f:
+            f.write(u'{"lat": 58.411, "lng": 15.622}\n{"lat": \n[1]\n')
+        self.assertEqual(0, cli.main([points, output, "--local", store,
+                                      "--quiet"]))
+        with io.open(output, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(u"Link\xf6ping", rows[0]["geonames"][0]["name"])
+        self.assertTrue(rows[1]["error"].startswith("JSONDecodeError"))
+        self.assertEqual({"row": 2, "error": "ValueError: not a JSON object"},
+                         rows[2])
+
+    def test_refresh(self):
+        live = LiveDataset(Dataset(self.local, self.hierarchy, self.search,
+                                   "2024-01-01"))
+        before = live.current
+        updater = Updater(live)
+        updater.apply_files(testdata, "2024-01-02")
+        self.assertEqual("2024-01-02", live.current.version)
+        self.assertEqual(before, (self.local, self.hierarchy, self.search,
+                                  "2024-01-01"))
+        self.assertEqual(len(self.local) - 1, len(live))
+
+        nearby = live.find_nearby_toponym(latlons["lkpg"], radius=5,
+                                          max_rows=3)
+        self.assertEqual([2694762, 9999999],
+                         [n["geonameId"] for n in nearby])
+        self.assertEqual(110000, live.get(2694762)["population"])
+        self.assertFalse(8128618 in live)
+
+        # The deleted ADM2 parent is skipped.
+        names = lambda geonames: [g["name"] for g in geonames]
+        self.assertEqual([u"Earth", u"Europe", u"Sweden", u"\xd6sterg\xf6tland",
+                          u"Nyby"], names(live.get_hierarchy(9999999)))
+        self.assertEqual(names(self.hierarchy.get_hierarchy(2666199)),
+                         names(live.get_hierarchy(2666199)))
+        self.assertRaises(errors.RecordDoesNotExist, live.get_hierarchy,
+                          8128618)
+
+        self.assertEqual([110000], [g["population"] for g in
+                                    live.search(q="linkoping")])
+        self.assertEqual([u"Link\xf6ping"], names(live.search(q="lincopia")))
+        self.assertEqual([u"Malm\xf6"], names(live.search(q="ellbogen")))
+        self.assertEqual([], live.search(q="ubsola"))
+        self.assertEqual([], live.search(q="kyrka"))
+        for bias in ["NO", ["NO"]]:
+            self.assertEqual(
+                    names(self.search.search(q="oslo stockholm uppsala",
+                                             operator="OR",
+                                             country_bias=bias)),
+                    names(live.search(q="oslo stockholm uppsala",
+                                      operator="OR", country_bias=bias)))
+
+        # Later diffs go through the same updater.
+        self.assertRaises(errors.GeogotchiError, Updater, live)
+        updater.apply(deletes=io.StringIO(u"2666199\tUppsala\t\n"),
+                      version="2024-01-03")
+        self.assertFalse(2666199 in live)
+        nearby = live.find_nearby_toponym(latlons["uppsala"])
+        self.assertNotIn(2666199, [n["geonameId"] for n in nearby])
+        self.assertEqual([110000], [g["population"] for g in
+                                    live.search(q="linkoping")])